@@ -0,0 +1,97 @@
+from typing import List, Tuple
+import time
+import heapq
+import asyncio
+from itertools import count
+from aiobbox.exceptions import ServiceOverloaded
+from aiobbox import stats
+from aiobbox import priority as bbox_priority
+
+# (dispatch key, sequence, priority, future)
+Waiter = Tuple[float, int, str, asyncio.Future]
+
+class Admission:
+    '''
+    Bounds the calls of one method running at once, calls beyond
+    max_concurrency wait in a queue of at most max_queue entries and
+    are rejected as overloaded beyond that.  Waiters are served by
+    priority, aged by the time they have waited; a full queue sheds
+    its least urgent waiter for a more urgent newcomer.  The limits
+    are passed on every call so that config changes apply at once
+    '''
+    def __init__(self, stats_name: str) -> None:
+        self.stats_name = stats_name
+        self.inflight = 0
+        self.waiters: List[Waiter] = []
+        self.seq = count()
+
+    @property
+    def queued(self) -> int:
+        return len(self.waiters)
+
+    async def acquire(self, max_concurrency: int=0, max_queue: int=0, priority: str=bbox_priority.DEFAULT_PRIORITY) -> None:
+        if max_concurrency <= 0 or (
+                self.inflight < max_concurrency and not self.waiters):
+            self.inflight += 1
+            self.report()
+            return
+
+        priority = bbox_priority.normalize(priority)
+        now = time.time()
+        key = now + (bbox_priority.rank(priority) *
+                     bbox_priority.PRIORITY_AGING_SECS)
+        if len(self.waiters) >= max_queue:
+            worst = max(self.waiters) if self.waiters else None
+            if worst is None or worst[0] <= key:
+                stats.overloaded_rpc_request_count.incr(self.stats_name)
+                raise self.overloaded()
+            self.remove(worst)
+            stats.overloaded_rpc_request_count.incr(self.stats_name)
+            worst[3].set_exception(self.overloaded())
+
+        fut = asyncio.get_event_loop().create_future()
+        waiter = (key, next(self.seq), priority, fut)
+        heapq.heappush(self.waiters, waiter)
+        stats.queued_priority_gauge.incr(priority, 1)
+        self.report()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # a slot was handed over just before the cancel
+                self.release(max_concurrency)
+            elif waiter in self.waiters:
+                self.remove(waiter)
+            raise
+        finally:
+            stats.priority_wait_seconds.incr(priority, time.time() - now)
+
+    def overloaded(self) -> ServiceOverloaded:
+        return ServiceOverloaded(
+            '{} calls running and {} queued'.format(
+                self.inflight, len(self.waiters)),
+            retry_after=0)
+
+    def remove(self, waiter: Waiter) -> None:
+        self.waiters.remove(waiter)
+        heapq.heapify(self.waiters)
+        stats.queued_priority_gauge.incr(waiter[2], -1)
+        self.report()
+
+    def release(self, max_concurrency: int=0) -> None:
+        self.inflight -= 1
+        # wake the most urgent waiters while there are free slots
+        while self.waiters and (max_concurrency <= 0 or
+                                self.inflight < max_concurrency):
+            _, _, priority, fut = heapq.heappop(self.waiters)
+            stats.queued_priority_gauge.incr(priority, -1)
+            if not fut.done():
+                fut.set_result(None)
+                self.inflight += 1
+        self.report()
+
+    def report(self) -> None:
+        stats.inflight_rpc_request_gauge.setv(
+            self.stats_name, self.inflight)
+        stats.queued_rpc_request_gauge.setv(
+            self.stats_name, len(self.waiters))
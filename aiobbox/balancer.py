@@ -0,0 +1,175 @@
+from typing import Dict, Any, List, Callable, Sequence, Optional, Tuple, Container
+import time
+import random
+import bisect
+from hashlib import md5
+from collections import deque
+from aiobbox.utils import localbox_ip
+
+# weight of the newest sample in the latency moving average
+EWMA_ALPHA = 0.3
+
+class BindStats:
+    '''
+    Client side statistics of one box bind, fed by every request
+    '''
+    def __init__(self) -> None:
+        self.inflight: int = 0
+        self.requests: int = 0
+        self.errors: int = 0
+        self.ewma: float = 0.0
+        self.last_used: float = time.time()
+
+    def start(self) -> float:
+        self.inflight += 1
+        self.last_used = time.time()
+        return self.last_used
+
+    def finish(self, start_time: float, ok: bool=True) -> None:
+        now = time.time()
+        self.inflight -= 1
+        self.requests += 1
+        if not ok:
+            self.errors += 1
+        elapsed = now - start_time
+        if self.requests == 1:
+            self.ewma = elapsed
+        else:
+            self.ewma = EWMA_ALPHA * elapsed + (1 - EWMA_ALPHA) * self.ewma
+        self.last_used = now
+
+    def load_score(self) -> float:
+        # expected wait of a new request queued behind the in-flight ones
+        return self.ewma * (self.inflight + 1)
+
+class LatencyWindow:
+    '''
+    Latencies of the most recent successful calls of one method
+    '''
+    def __init__(self, size: int=200) -> None:
+        self.samples: deque = deque(maxlen=size)
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def add(self, secs: float) -> None:
+        self.samples.append(secs)
+
+    def percentile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        arr = sorted(self.samples)
+        index = min(len(arr) - 1, int(len(arr) * q))
+        return arr[index]
+
+class RequestBudget:
+    '''
+    Token bucket allowing extra requests, e.g. hedges or retries, up
+    to a ratio of the normal requests
+    '''
+    def __init__(self, ratio: float, max_tokens: float=10.0) -> None:
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+    def deposit(self) -> None:
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+StatsMap = Dict[str, BindStats]
+Policy = Callable[[Sequence[str], StatsMap], str]
+
+_empty_stats = BindStats()
+
+def _get(stats: StatsMap, bind: str) -> BindStats:
+    return stats.get(bind, _empty_stats)
+
+def choose_first(binds: Sequence[str], stats: StatsMap) -> str:
+    return binds[0]
+
+def choose_random(binds: Sequence[str], stats: StatsMap) -> str:
+    return random.choice(binds)
+
+def choose_p2c(binds: Sequence[str], stats: StatsMap) -> str:
+    '''
+    Power of two choices, pick the less busy of two random binds
+    '''
+    if len(binds) < 2:
+        return binds[0]
+    a, b = random.sample(binds, 2)
+    if _get(stats, b).inflight < _get(stats, a).inflight:
+        return b
+    return a
+
+def choose_least_outstanding(binds: Sequence[str], stats: StatsMap) -> str:
+    least = min(_get(stats, bind).inflight for bind in binds)
+    return random.choice([bind for bind in binds
+                          if _get(stats, bind).inflight == least])
+
+def choose_ewma(binds: Sequence[str], stats: StatsMap) -> str:
+    '''
+    Of two random binds pick the one with the smaller latency
+    weighted load, binds without samples score zero and get probed
+    '''
+    if len(binds) < 2:
+        return binds[0]
+    a, b = random.sample(binds, 2)
+    if _get(stats, b).load_score() < _get(stats, a).load_score():
+        return b
+    return a
+
+def locality_tiers(binds: Sequence[str], boxes: Dict[str, Any], zone: str='') -> List[List[str]]:
+    '''
+    Split binds into same host, same zone and remote tiers, empty
+    tiers are left out
+    '''
+    same_host: List[str] = []
+    same_zone: List[str] = []
+    remote: List[str] = []
+    for bind in binds:
+        if localbox_ip(bind.split(':')[0]):
+            same_host.append(bind)
+        elif zone and (boxes.get(bind) or {}).get('zone') == zone:
+            same_zone.append(bind)
+        else:
+            remote.append(bind)
+    return [tier for tier in (same_host, same_zone, remote) if tier]
+
+# virtual nodes of each bind on a hash ring
+DEFAULT_VNODES = 160
+
+def hash_point(v: str) -> int:
+    return int(md5(v.encode('utf-8')).hexdigest()[:16], 16)
+
+class HashRing:
+    '''
+    Consistent hash ring with virtual nodes, a key keeps mapping to
+    the same bind while only the keys of leaving or joining binds move
+    '''
+    def __init__(self, binds: Sequence[str], vnodes: int=DEFAULT_VNODES) -> None:
+        self.binds: Tuple[str, ...] = tuple(sorted(set(binds)))
+        points = []
+        for bind in self.binds:
+            for i in range(vnodes):
+                points.append((hash_point('{}#{}'.format(bind, i)), bind))
+        points.sort()
+        self.points = [p for p, _ in points]
+        self.nodes = [bind for _, bind in points]
+
+    def get(self, key: Any, allowed: Optional[Container[str]]=None) -> Optional[str]:
+        '''
+        The first bind clockwise of key, skipping binds not allowed
+        '''
+        if not self.points:
+            return None
+        start = bisect.bisect(self.points, hash_point(str(key)))
+        for i in range(len(self.nodes)):
+            bind = self.nodes[(start + i) % len(self.nodes)]
+            if allowed is None or bind in allowed:
+                return bind
+        return None
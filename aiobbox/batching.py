@@ -0,0 +1,83 @@
+'''
+Grouping of concurrent calls to a method into one call of its batch
+implementation
+'''
+from typing import List, Tuple, Any, Callable, Optional
+import asyncio
+import logging
+import inspect
+from aiobbox import stats
+
+logger = logging.getLogger('bbox')
+
+# seconds the first call of a batch waits for others to join
+DEFAULT_BATCH_WINDOW = 0.005
+# calls beyond this are dispatched in the next batch
+DEFAULT_BATCH_SIZE = 500
+
+BatchFn = Callable[[List[Tuple[Any, ...]]], Any]
+
+class Batcher:
+    '''
+    Collects the params of the calls arriving within window seconds,
+    or until max_size calls, and dispatches them to fn(params_list)
+    at once.  fn is a plain or a coroutine function returning one
+    result per params tuple in order, a result that is an exception
+    is raised to its caller only
+    '''
+    def __init__(self, stats_name: str, fn: BatchFn, window: float=DEFAULT_BATCH_WINDOW, max_size: int=DEFAULT_BATCH_SIZE) -> None:
+        self.stats_name = stats_name
+        self.fn = fn
+        self.window = window
+        self.max_size = max_size
+        self.pending: List[Tuple[Tuple[Any, ...], asyncio.Future]] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    async def submit(self, params: Any) -> Any:
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        self.pending.append((tuple(params), fut))
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self.flush)
+        return await fut
+
+    def flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        # callers gone before the dispatch are left out
+        batch = [(params, fut) for params, fut in self.pending
+                 if not fut.done()]
+        self.pending = []
+        if batch:
+            asyncio.ensure_future(self.dispatch(batch))
+
+    async def dispatch(self, batch: List[Tuple[Tuple[Any, ...], asyncio.Future]]) -> None:
+        stats.batch_count.incr(self.stats_name)
+        stats.batch_call_count.incr(self.stats_name, len(batch))
+        try:
+            results = self.fn([params for params, _ in batch])
+            if inspect.isawaitable(results):
+                results = await results
+            results = list(results)
+            if len(results) != len(batch):
+                raise ValueError(
+                    'batch of {} calls got {} results'.format(
+                        len(batch), len(results)))
+        except Exception as e:
+            logger.warn('batch of %s failed', self.stats_name,
+                        exc_info=True)
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        for (_, fut), result in zip(batch, results):
+            if fut.done():
+                continue
+            if isinstance(result, Exception):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
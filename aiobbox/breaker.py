@@ -0,0 +1,69 @@
+from typing import Optional
+import time
+import logging
+
+logger = logging.getLogger('bbox')
+
+class CircuitBreaker:
+    '''
+    Per bind circuit breaker, consecutive failures open the circuit
+    and eject the bind, after reset_timeout one half open probe is
+    let through to decide whether it is readmitted
+    '''
+    CLOSED = 'closed'
+    HALF_OPEN = 'half_open'
+    OPEN = 'open'
+
+    def __init__(self, bind: str, failure_threshold: int=5, reset_timeout: float=5.0) -> None:
+        self.bind = bind
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def available(self, now: Optional[float]=None) -> bool:
+        '''
+        Whether the bind may be chosen for a new request
+        '''
+        if self.state == self.CLOSED:
+            return True
+        now = now or time.time()
+        if self.state == self.OPEN:
+            return now - self.opened_at >= self.reset_timeout
+        # half open, only one probe at a time
+        return not self.probing
+
+    def on_request(self) -> None:
+        if self.state == self.OPEN and self.available():
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            self.probing = True
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.info('circuit of box %s closed', self.bind)
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.probing = False
+        if (self.state == self.HALF_OPEN or
+            self.failures >= self.failure_threshold):
+            if self.state != self.OPEN:
+                logger.warn('circuit of box %s opened after %s failures',
+                            self.bind, self.failures)
+            self.state = self.OPEN
+            self.opened_at = time.time()
+
+    def record_cancel(self) -> None:
+        # the call was abandoned by the caller, it proves nothing
+        self.probing = False
+
+    def state_value(self) -> int:
+        return {self.CLOSED: 0,
+                self.HALF_OPEN: 1,
+                self.OPEN: 2}[self.state]
@@ -0,0 +1,48 @@
+from typing import Any, Callable, Hashable, Tuple
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    '''
+    Bounded LRU cache whose entries also expire after a per entry TTL
+    '''
+    def __init__(self, maxsize: int=1024) -> None:
+        self.maxsize = maxsize
+        self.entries: 'OrderedDict[Hashable, Tuple[float, Any]]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key) is not None
+
+    def get(self, key: Hashable, default: Any=None) -> Any:
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        expire_at, value = entry
+        if expire_at < time.time():
+            del self.entries[key]
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float) -> None:
+        if self.maxsize <= 0:
+            return
+        self.entries[key] = (time.time() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        self.entries.pop(key, None)
+
+    def delete_if(self, pred: Callable[[Hashable], bool]) -> int:
+        keys = [key for key in self.entries.keys() if pred(key)]
+        for key in keys:
+            del self.entries[key]
+        return len(keys)
+
+    def clear(self) -> None:
+        self.entries.clear()
@@ -1,5 +1,6 @@
-from typing import Dict, Any, List, Union, Iterable, Optional
+from typing import Dict, Any, List, Union, Iterable, Optional, Tuple, AsyncIterator
 import logging
+import weakref
 import time
 import sys, os
 import asyncio
@@ -8,22 +9,72 @@ import aiohttp
 from urllib.parse import urljoin
 import json
 from aiohttp import ClientConnectorError
-from aiobbox.cluster import get_cluster
-from aiobbox.exceptions import ConnectionError, Retry, NoServiceFound
-from aiobbox.utils import  get_cert_ssl_context, next_request_id
+from aiobbox.cluster import get_cluster, get_box, get_ticket
+from aiobbox.exceptions import ConnectionError, Retry, NoServiceFound, ServiceError
+from aiobbox.utils import  get_cert_ssl_context, next_request_id, json_to_str, localbox_ip
+from aiobbox import balancer, stats as bbox_stats
+from aiobbox.balancer import BindStats, LatencyWindow, RequestBudget, HashRing
+from aiobbox.cache import LRUCache
+from aiobbox.breaker import CircuitBreaker
+from aiobbox.metrics import add_metrics, IMetricsEntry, MEntry
+from aiobbox import deadline as bbox_deadline
+from aiobbox import priority as bbox_priority
+from aiobbox import codecs
+from aiobbox import compress
 
-from aiobbox.jsonrpc import Request
-from aiobbox.server import has_service, ServiceRequest
+from aiobbox.jsonrpc import Request, BatchRequest
+from aiobbox.server import has_service, ServiceRequest, StreamResult, WS_MAX_MSG_SIZE
 
 logger = logging.getLogger('bbox')
 
 DEFAULT_TIMEOUT_SECS = 30
 
+# keep-alive connection pool settings
+DEFAULT_CONNS_PER_BOX = 64
+DEFAULT_KEEPALIVE_SECS = 30.0
+DEFAULT_IDLE_SECS = 300.0
+SWEEP_INTERVAL_SECS = 1.0
+WS_HEARTBEAT_SECS = 10.0
+
+# automatic micro batching, disabled while batch_window is 0
+DEFAULT_BATCH_SIZE = 32
+
+# responses kept for methods declaring a cache_ttl
+DEFAULT_CACHE_SIZE = 1024
+
+# circuit breaker, consecutive failures before ejecting a box
+# and seconds before a half open probe
+DEFAULT_BREAKER_FAILURES = 5
+DEFAULT_BREAKER_RESET_SECS = 5.0
+
+# hedged requests, the delay used before a method has latency
+# samples and the extra load hedging may add
+DEFAULT_HEDGE_DELAY_SECS = 0.05
+DEFAULT_HEDGE_PERCENTILE = 0.95
+DEFAULT_HEDGE_RATIO = 0.1
+
+# retries, the share of normal traffic a service may get as retries
+# and the jittered exponential backoff between attempts
+DEFAULT_RETRY_RATIO = 0.2
+RETRY_BACKOFF_BASE_SECS = 0.05
+RETRY_BACKOFF_MAX_SECS = 2.0
+
+# encodings each box accepts for request bodies, learned from the
+# headers of its responses
+peer_encodings: Dict[str, str] = {}
+
 class HttpClient:
     session: Optional[aiohttp.ClientSession]
 
-    def __init__(self, connect: str, expect: str='text') -> None:
+    def __init__(self, connect: str, expect: str='text', session: Optional[aiohttp.ClientSession]=None, ws: Optional['WebSocketTransport']=None, codec: str=None) -> None:
         self.expect = expect
+        self.connect = connect
+        self.codec = codecs.get_codec(codec)
+        # multiplexed websocket to the box, used instead of HTTP posts
+        self.ws = ws
+        # the pooled connection lending its session, released by the
+        # pool when the call is done
+        self.conn: Optional['BoxConnection'] = None
         c = get_cluster()
         box = c.boxes[connect]
         self.ssl_prefix = box['ssl']
@@ -31,9 +82,15 @@ class HttpClient:
             self.url_prefix = 'https://' + connect
         else:
             self.url_prefix = 'http://' + connect
-        ssl_context = get_cert_ssl_context(self.ssl_prefix)
-        conn = aiohttp.TCPConnector(ssl_context=ssl_context)
-        self.session = aiohttp.ClientSession(connector=conn)
+        if session is not None:
+            # borrowed from a long lived BoxConnection, never closed here
+            self.session = session
+            self.own_session = False
+        else:
+            ssl_context = get_cert_ssl_context(self.ssl_prefix)
+            conn = aiohttp.TCPConnector(ssl_context=ssl_context)
+            self.session = aiohttp.ClientSession(connector=conn)
+            self.own_session = True
 
     async def request(self, srv: str, method: str, *params: Any, req_id:Any=None, timeout: float=DEFAULT_TIMEOUT_SECS) -> Any:
         '''
@@ -45,10 +102,26 @@ class HttpClient:
         return await self.request_obj(req, timeout=timeout)
 
     async def request_obj(self, req: Request, timeout:float =DEFAULT_TIMEOUT_SECS) -> Any:
+        return await self.post_payload(req.as_json(), timeout=timeout)
+
+    async def request_batch(self, batch: BatchRequest, timeout:float =DEFAULT_TIMEOUT_SECS) -> List[Dict[str, Any]]:
+        resp = await self.post_payload(batch.as_json(), timeout=timeout)
+        return batch.match_responses(resp)
+
+    async def post_payload(self, payload: Any, timeout:float =DEFAULT_TIMEOUT_SECS) -> Any:
+        if self.ws is not None:
+            return await self.ws.send_payload(payload, timeout=timeout)
         url = urljoin(self.url_prefix,
                       '/jsonrpc/2.0/api')
-        payload = req.as_json()
-        headers = {'X-Bbox-Expect-Timeout': str(timeout)}
+        headers = {'X-Bbox-Expect-Timeout': str(timeout),
+                   'Content-Type': self.codec.content_type,
+                   'Accept': self.codec.content_type}
+        data, encoding = compress.compress_body(
+            self.codec.encode(payload),
+            peer_encodings.get(self.url_prefix),
+            'client')
+        if encoding:
+            headers['Content-Encoding'] = encoding
         req_start_time = time.time()
         try:
             for i in range(2):
@@ -57,12 +130,17 @@ class HttpClient:
                     async with self.session.post(
                             url,
                             headers=headers,
-                            json=payload,
+                            data=data,
                             timeout=timeout) as resp:
+                        accept_encoding = resp.headers.get(
+                            compress.ACCEPT_HEADER)
+                        if accept_encoding:
+                            peer_encodings[self.url_prefix] = accept_encoding
                         if self.expect == 'text':
                             return await resp.text()
                         else:
-                            return await resp.json()
+                            codec = codecs.get_codec(resp.content_type)
+                            return codec.decode(await read_body(resp))
                 except ClientConnectorError:
                     logging.warn("connect json rpc error %s, try refresh get_boxes and call again", url)
                     await get_cluster().get_boxes()
@@ -76,14 +154,216 @@ class HttpClient:
                     'url %s, payload %s, used %s seconds',
                     url, payload, used_time)
 
+    async def stream_obj(self, req: Request, timeout: float=DEFAULT_TIMEOUT_SECS) -> AsyncIterator[Dict[str, Any]]:
+        '''
+        Post a request for a streaming method and yield the NDJSON
+        lines of the response as they arrive, a box that does not
+        stream answers with one ordinary response
+        '''
+        url = urljoin(self.url_prefix,
+                      '/jsonrpc/2.0/api')
+        headers = {'X-Bbox-Expect-Timeout': str(timeout),
+                   'Content-Type': codecs.JSON_CONTENT_TYPE,
+                   'Accept': '{}, {}'.format(codecs.NDJSON_CONTENT_TYPE,
+                                             codecs.JSON_CONTENT_TYPE)}
+        # timeout bounds the wait for every line, not the whole stream
+        client_timeout = aiohttp.ClientTimeout(sock_connect=timeout,
+                                               sock_read=timeout)
+        assert self.session is not None
+        async with self.session.post(
+                url,
+                headers=headers,
+                data=codecs.json_codec.encode(req.as_json()),
+                timeout=client_timeout) as resp:
+            if resp.content_type != codecs.NDJSON_CONTENT_TYPE:
+                codec = codecs.get_codec(resp.content_type)
+                yield codec.decode(await resp.read())
+                return
+            # reading no further than the consumer lets the socket
+            # buffers fill up, which pauses the box
+            buf = b''
+            async for chunk in resp.content.iter_any():
+                buf += chunk
+                lines = buf.split(b'\n')
+                buf = lines.pop()
+                for line in lines:
+                    if line:
+                        yield codecs.json_codec.decode(line)
+            if buf.strip():
+                yield codecs.json_codec.decode(buf)
+
     async def close(self):
-        if self.session is not None:
+        if self.session is not None and self.own_session:
             await self.session.close()
 
+class WebSocketTransport:
+    '''
+    One websocket to a box multiplexing any number of in-flight
+    requests, responses are matched to callers by request id
+    '''
+    def __init__(self, url_prefix: str, session: aiohttp.ClientSession, codec: str=None) -> None:
+        self.url = urljoin(url_prefix, '/jsonrpc/2.0/ws')
+        self.session = session
+        # binary codecs go in binary frames, json in text frames
+        self.codec = codecs.get_codec(codec)
+        self.ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        self.waiters: Dict[int, asyncio.Future] = {}
+        self.connect_lock = asyncio.Lock()
+        self.reader: Optional[asyncio.Future] = None
+
+    @property
+    def connected(self) -> bool:
+        return self.ws is not None and not self.ws.closed
+
+    async def connect(self) -> aiohttp.ClientWebSocketResponse:
+        async with self.connect_lock:
+            if self.ws is None or self.ws.closed:
+                try:
+                    self.ws = await self.session.ws_connect(
+                        self.url, heartbeat=WS_HEARTBEAT_SECS,
+                        max_msg_size=WS_MAX_MSG_SIZE)
+                except (aiohttp.ClientError, OSError) as e:
+                    raise ConnectionError(
+                        'cannot connect websocket {}'.format(self.url)) from e
+                self.reader = asyncio.ensure_future(
+                    self._read_loop(self.ws))
+            return self.ws
+
+    async def send_payload(self, payload: Any, timeout: float=DEFAULT_TIMEOUT_SECS) -> Any:
+        '''
+        Send a request or a batch and wait for the responses, an id
+        already in flight on this socket is replaced on the wire and
+        restored in its response
+        '''
+        ws = await self.connect()
+        is_batch = isinstance(payload, list)
+        entries = payload if is_batch else [payload]
+        loop = asyncio.get_event_loop()
+        wire = []
+        pending: List[Tuple[Any, int, asyncio.Future]] = []
+        for entry in entries:
+            entry = dict(entry, timeout=timeout)
+            if entry.get('id') is not None:
+                # errors quote the wire id, keep the caller's if we can
+                wire_id = entry['id']
+                while wire_id in self.waiters:
+                    wire_id = next_request_id()
+                fut = loop.create_future()
+                self.waiters[wire_id] = fut
+                pending.append((entry['id'], wire_id, fut))
+                entry['id'] = wire_id
+            wire.append(entry)
+        try:
+            data = self.codec.encode(wire if is_batch else wire[0])
+            if self.codec.binary:
+                await ws.send_bytes(data)
+            else:
+                await ws.send_str(data.decode('utf-8'))
+            resps = await asyncio.wait_for(
+                asyncio.gather(*[fut for _, _, fut in pending]),
+                timeout)
+        except ConnectionResetError as e:
+            raise ConnectionError(
+                'websocket closed on sending req') from e
+        finally:
+            for _, wire_id, _ in pending:
+                self.waiters.pop(wire_id, None)
+        resps = [dict(resp, id=req_id)
+                 for (req_id, _, _), resp in zip(pending, resps)]
+        return resps if is_batch else resps[0]
+
+    async def _read_loop(self, ws: aiohttp.ClientWebSocketResponse) -> None:
+        try:
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    data = codecs.json_codec.decode(msg.data)
+                elif msg.type == aiohttp.WSMsgType.BINARY:
+                    data = self.codec.decode(msg.data)
+                else:
+                    continue
+                for resp in (data if isinstance(data, list) else [data]):
+                    fut = self.waiters.pop(resp.get('id'), None)
+                    if fut is not None and not fut.done():
+                        fut.set_result(resp)
+        except Exception:
+            logger.warn('websocket %s read error', self.url, exc_info=True)
+        finally:
+            if self.ws is ws:
+                self.ws = None
+            waiters, self.waiters = self.waiters, {}
+            for fut in waiters.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError(
+                        'websocket {} closed'.format(self.url)))
+
+    async def close(self) -> None:
+        if self.ws is not None:
+            await self.ws.close()
+            self.ws = None
+
+class BoxConnection:
+    '''
+    Long lived keep-alive HTTP session to one box bind
+    '''
+    def __init__(self, bind: str, ssl_prefix: Optional[str], limit: int=DEFAULT_CONNS_PER_BOX, keepalive_timeout: float=DEFAULT_KEEPALIVE_SECS, unix_path: str='', box_unix: Optional[str]=None) -> None:
+        self.bind = bind
+        self.ssl_prefix = ssl_prefix
+        self.unix_path = unix_path
+        # the unix socket the box advertised when unix_path was resolved
+        self.box_unix = box_unix
+        conn: aiohttp.BaseConnector
+        if unix_path:
+            conn = aiohttp.UnixConnector(
+                path=unix_path,
+                limit=limit,
+                keepalive_timeout=keepalive_timeout)
+        else:
+            ssl_context = get_cert_ssl_context(ssl_prefix)
+            conn = aiohttp.TCPConnector(
+                ssl_context=ssl_context,
+                limit=limit,
+                limit_per_host=limit,
+                keepalive_timeout=keepalive_timeout)
+        self.session = aiohttp.ClientSession(connector=conn)
+        self.ws: Optional[WebSocketTransport] = None
+        self.pending = 0
+        self.last_used = time.time()
+
+    def acquire(self) -> None:
+        self.pending += 1
+        self.last_used = time.time()
+
+    def release(self) -> None:
+        self.pending -= 1
+        self.last_used = time.time()
+
+    def is_idle(self, idle_secs: float, now: float) -> bool:
+        return (self.pending <= 0 and
+                now - self.last_used > idle_secs)
+
+    def get_ws(self, url_prefix: str, codec: str=None) -> WebSocketTransport:
+        if self.ws is None:
+            self.ws = WebSocketTransport(url_prefix, self.session,
+                                         codec=codec)
+        return self.ws
+
+    async def close(self) -> None:
+        if self.ws is not None:
+            await self.ws.close()
+        await self.session.close()
+
 class ServiceRef:
-    def __init__(self, srv_name: str, pool: 'ServicePool') -> None:
+    def __init__(self, srv_name: str, pool: 'ServicePool', hash_key: Any=None) -> None:
         self.name:str = srv_name
         self.pool:ServicePool = pool
+        self.hash_key = hash_key
+
+    def with_key(self, hash_key: Any) -> 'ServiceRef':
+        '''
+        Route every call through this ref to the box that owns
+        hash_key on the consistent hash ring of the service
+        '''
+        return ServiceRef(self.name, self.pool, hash_key=hash_key)
 
     def __getattr__(self, name: str) -> Any:
         return MethodRef(name, self)
@@ -94,90 +374,820 @@ class MethodRef:
         self.srv_ref = srv_ref
 
     async def __call__(self, *params:Any, **kw:Any) -> Any:
+        if self.srv_ref.hash_key is not None:
+            kw.setdefault('hash_key', self.srv_ref.hash_key)
         return await self.srv_ref.pool.request(
             self.srv_ref.name,
             self.name,
             *params,
             **kw)
 
+    def stream(self, *params: Any, **kw: Any) -> AsyncIterator[Any]:
+        if self.srv_ref.hash_key is not None:
+            kw.setdefault('hash_key', self.srv_ref.hash_key)
+        return self.srv_ref.pool.stream(
+            self.srv_ref.name,
+            self.name,
+            *params,
+            **kw)
+
+PolicyType = Union[int, balancer.Policy]
+HedgeType = Union[None, bool, float]
+
+class BatchServiceRef:
+    def __init__(self, srv_name: str, batch: 'Batch') -> None:
+        self.name = srv_name
+        self.batch = batch
+
+    def __getattr__(self, name: str) -> Any:
+        return BatchMethodRef(name, self)
+
+class BatchMethodRef:
+    def __init__(self, name: str, srv_ref: BatchServiceRef) -> None:
+        self.name = name
+        self.srv_ref = srv_ref
+
+    def __call__(self, *params: Any) -> int:
+        return self.srv_ref.batch.add(
+            self.srv_ref.name, self.name, *params)
+
+class Batch:
+    '''
+    Collect calls and send them as JSON-RPC batches, one per service
+
+        batch = pool.batch()
+        batch.calc.add2num(1, 2)
+        batch.calc.add2num(3, 4)
+        resps = await batch.run()
+    '''
+    def __init__(self, pool: 'SimpleHttpPool') -> None:
+        self.pool = pool
+        self.reqs: List[Request] = []
+
+    def add(self, srv_name: str, method: str, *params: Any) -> int:
+        '''
+        Add a call and return its index in the results of run()
+        '''
+        req = Request.make(next_request_id(), srv_name, method, *params)
+        self.reqs.append(req)
+        return len(self.reqs) - 1
+
+    def __len__(self) -> int:
+        return len(self.reqs)
+
+    def __getattr__(self, name: str) -> BatchServiceRef:
+        return BatchServiceRef(name, self)
+
+    def __getitem__(self, name: str) -> BatchServiceRef:
+        return BatchServiceRef(name, self)
+
+    async def run(self, **kw: Any) -> List[Dict[str, Any]]:
+        reqs, self.reqs = self.reqs, []
+        return await self.pool.request_batch(reqs, **kw)
+
+BatchKey = Tuple[str, int, Any]
+BatchEntry = Tuple[Request, asyncio.Future, float]
+
+class AutoBatcher:
+    '''
+    Hold concurrent calls to the same service for a short window, or
+    until batch_size calls are queued, and ship them as one batch
+    '''
+    def __init__(self, pool: 'SimpleHttpPool') -> None:
+        self.pool = pool
+        self.queues: Dict[BatchKey, List[BatchEntry]] = {}
+        self.timers: Dict[BatchKey, asyncio.TimerHandle] = {}
+
+    async def request_obj(self, req: Request, timeout: float=DEFAULT_TIMEOUT_SECS, retry: int=0, policy: PolicyType=None) -> Any:
+        # request ids must be unique inside a batch
+        breq = req.clone()
+        breq.req_id = next_request_id()
+
+        # timeouts differ by the deadlines of the callers, they do
+        # not split batches
+        key = (req.srv_name, retry, policy)
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = []
+            self.queues[key] = queue
+            self.timers[key] = loop.call_later(
+                self.pool.batch_window, self.flush, key)
+        queue.append((breq, fut, timeout))
+        if len(queue) >= self.pool.batch_size:
+            self.flush(key)
+
+        resp = await asyncio.wait_for(fut, timeout)
+        resp = dict(resp)
+        resp['id'] = req.req_id
+        return resp
+
+    def flush(self, key: BatchKey) -> None:
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        queue = self.queues.pop(key, None)
+        if queue:
+            asyncio.ensure_future(self._send(key, queue))
+
+    async def _send(self, key: BatchKey, queue: List[BatchEntry]) -> None:
+        srv_name, retry, policy = key
+        batch = BatchRequest([breq for breq, _, _ in queue])
+        # callers with shorter timeouts stop waiting on their own
+        timeout = max(timeout for _, _, timeout in queue)
+        try:
+            resps = await self.pool._request_group(
+                srv_name, batch,
+                timeout=timeout, retry=retry, policy=policy)
+        except Exception as e:
+            for _, fut, _ in queue:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for (_, fut, _), resp in zip(queue, resps):
+            if not fut.done():
+                fut.set_result(resp)
+
+async def read_body(resp: aiohttp.ClientResponse) -> bytearray:
+    '''
+    Read a body chunk by chunk into one buffer as it arrives, big
+    responses are written in pieces and are not copied again by
+    joining the chunks
+    '''
+    buf = bytearray()
+    async for chunk in resp.content.iter_any():
+        buf.extend(chunk)
+    return buf
+
+async def aiter_list(items: List[Any]) -> AsyncIterator[Any]:
+    for item in items:
+        yield item
+
+def get_retry_after(resp: Any) -> Optional[float]:
+    '''
+    The back off hint of an overloaded error response, if any
+    '''
+    if not isinstance(resp, dict):
+        return None
+    error = resp.get('error')
+    if not isinstance(error, dict):
+        return None
+    retry_after = error.get('retry_after')
+    if retry_after is None and error.get('code') == 'overloaded':
+        retry_after = 0
+    return retry_after
+
 class ServicePool:
-    async def request(self, srv_name: str, method: str, *params:Any, boxid: str=None, retry: int=0, req_id: Any=None, timeout: float=DEFAULT_TIMEOUT_SECS):
+    async def request(self, srv_name: str, method: str, *params:Any, boxid: str=None, retry: int=0, req_id: Any=None, timeout: float=DEFAULT_TIMEOUT_SECS, policy: PolicyType=None, hedge: HedgeType=None, hash_key: Any=None, priority: Optional[str]=None):
         raise NotImplementedError
 
 class SimpleHttpPool(ServicePool):
-    ''' short term HTTP request '''
+    ''' HTTP requests over per box keep-alive connections '''
     FIRST = 1
     RANDOM = 2
+    P2C = 3
+    LEAST_OUTSTANDING = 4
+    EWMA = 5
+
+    # transports
+    HTTP = 'http'
+    WEBSOCKET = 'ws'
 
-    def __init__(self) -> None:
+    policies: Dict[int, balancer.Policy] = {
+        FIRST: balancer.choose_first,
+        RANDOM: balancer.choose_random,
+        P2C: balancer.choose_p2c,
+        LEAST_OUTSTANDING: balancer.choose_least_outstanding,
+        EWMA: balancer.choose_ewma,
+    }
+
+    def __init__(self,
+                 policy: PolicyType=RANDOM,
+                 conns_per_box: int=DEFAULT_CONNS_PER_BOX,
+                 keepalive_timeout: float=DEFAULT_KEEPALIVE_SECS,
+                 idle_timeout: float=DEFAULT_IDLE_SECS,
+                 batch_window: float=0,
+                 batch_size: int=DEFAULT_BATCH_SIZE,
+                 cache_size: int=DEFAULT_CACHE_SIZE,
+                 breaker_failures: int=DEFAULT_BREAKER_FAILURES,
+                 breaker_reset: float=DEFAULT_BREAKER_RESET_SECS,
+                 hedge_ratio: float=DEFAULT_HEDGE_RATIO,
+                 retry_ratio: float=DEFAULT_RETRY_RATIO,
+                 locality: bool=False,
+                 locality_max_inflight: int=None,
+                 use_unix: bool=True,
+                 transport: str=HTTP,
+                 codec: str='json') -> None:
         self.pool: Dict[str, ServiceRef] = {}
-        self.policy: int = self.RANDOM
+        self.policy: PolicyType = policy
+        self.stats: Dict[str, BindStats] = {}
+        self.conns_per_box = conns_per_box
+        self.keepalive_timeout = keepalive_timeout
+        self.idle_timeout = idle_timeout
+        self.connections: Dict[str, BoxConnection] = {}
+        self._last_sweep = 0.0
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.auto_batcher = AutoBatcher(self)
+        self.cache = LRUCache(cache_size)
+        self.cache_ttls: Dict[Tuple[str, str], float] = {}
+        self.breaker_failures = breaker_failures
+        self.breaker_reset = breaker_reset
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.hedge_methods: Dict[Tuple[str, str], HedgeType] = {}
+        self.hedge_budget = RequestBudget(hedge_ratio)
+        self.method_latency: Dict[Tuple[str, str], LatencyWindow] = {}
+        self.retry_ratio = retry_ratio
+        self.retry_budgets: Dict[str, RequestBudget] = {}
+        # prefer same host, then same zone boxes unless they are busy
+        self.locality = locality
+        self.locality_max_inflight = locality_max_inflight or conns_per_box
+        self.rings: Dict[str, HashRing] = {}
+        self.use_unix = use_unix
+        # unix sockets that failed to connect, by bind, TCP is used
+        # until the box advertises another path
+        self.failed_unix: Dict[str, str] = {}
+        self.transport = transport
+        if not codecs.has_codec(codec):
+            logger.warn('codec %s is not available, use json', codec)
+            codec = 'json'
+        self.codec = codec
+        _pools.add(self)
+
+    def get_connection(self, bind: str) -> BoxConnection:
+        self.sweep_connections()
+        box = get_cluster().boxes[bind]
+        conn = self.connections.get(bind)
+        if (conn is None or conn.ssl_prefix != box['ssl'] or
+            conn.box_unix != box.get('unix')):
+            if conn is not None:
+                self._discard_connection(conn)
+            # the socket file is looked up once per connection
+            conn = BoxConnection(
+                bind, box['ssl'],
+                limit=self.conns_per_box,
+                keepalive_timeout=self.keepalive_timeout,
+                unix_path=self.get_unix_path(bind, box),
+                box_unix=box.get('unix'))
+            self.connections[bind] = conn
+        return conn
+
+    def get_unix_path(self, bind: str, box: Dict[str, Any]) -> str:
+        '''
+        The unix socket of a box on this host, empty to use TCP
+        '''
+        unix_path = box.get('unix')
+        if (not self.use_unix or not unix_path or box['ssl'] or
+            not localbox_ip(bind.split(':')[0]) or
+            self.failed_unix.get(bind) == unix_path or
+            not os.path.exists(unix_path)):
+            return ''
+        return unix_path
 
-    def get_client(self, srv_name: str, policy: int=None, boxid: str=None) -> Optional[HttpClient]:
+    def sweep_connections(self, force: bool=False) -> None:
+        '''
+        Close connections to boxes that left the route or stayed idle
+        '''
+        now = time.time()
+        if not force and now - self._last_sweep < SWEEP_INTERVAL_SECS:
+            return
+        self._last_sweep = now
+        boxes = get_cluster().boxes
+        for bind, conn in list(self.connections.items()):
+            if bind not in boxes or conn.is_idle(self.idle_timeout, now):
+                self._discard_connection(conn)
+        for bind in list(self.stats.keys()):
+            if bind not in boxes:
+                del self.stats[bind]
+        for bind in list(self.breakers.keys()):
+            if bind not in boxes:
+                del self.breakers[bind]
+        for bind in list(self.failed_unix.keys()):
+            if bind not in boxes:
+                del self.failed_unix[bind]
+
+    def _discard_connection(self, conn: BoxConnection) -> None:
+        if self.connections.get(conn.bind) is conn:
+            del self.connections[conn.bind]
+        logger.debug('close connection to box %s', conn.bind)
+        asyncio.ensure_future(self._close_drained(conn))
+
+    async def _close_drained(self, conn: BoxConnection) -> None:
+        # let in-flight requests finish on the old session
+        while conn.pending > 0:
+            await asyncio.sleep(0.1)
+        await conn.close()
+
+    async def close(self) -> None:
+        conns = list(self.connections.values())
+        self.connections = {}
+        for conn in conns:
+            await conn.close()
+
+    def get_stats(self, bind: str) -> BindStats:
+        stats = self.stats.get(bind)
+        if stats is None:
+            stats = BindStats()
+            self.stats[bind] = stats
+        return stats
+
+    def get_breaker(self, bind: str) -> CircuitBreaker:
+        breaker = self.breakers.get(bind)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                bind,
+                failure_threshold=self.breaker_failures,
+                reset_timeout=self.breaker_reset)
+            self.breakers[bind] = breaker
+        return breaker
+
+    def get_zone(self) -> str:
+        return get_box().zone or get_ticket().zone
+
+    def prefer_local(self, binds: List[str]) -> List[str]:
+        '''
+        The nearest tier of binds that still has spare capacity
+        '''
+        tiers = balancer.locality_tiers(
+            binds, get_cluster().boxes, self.get_zone())
+        for tier in tiers:
+            ready = [bind for bind in tier
+                     if bind not in self.stats or
+                     self.stats[bind].inflight < self.locality_max_inflight]
+            if ready:
+                return ready
+        return binds
+
+    def get_policy(self, policy: PolicyType=None) -> balancer.Policy:
         policy = policy or self.policy
+        if callable(policy):
+            return policy
+        return self.policies[policy]
+
+    def get_ring(self, srv_name: str) -> HashRing:
+        binds = get_cluster().route[srv_name]
+        ring = self.rings.get(srv_name)
+        if ring is None or ring.binds != tuple(sorted(set(binds))):
+            ring = HashRing(binds)
+            self.rings[srv_name] = ring
+        return ring
+
+    def get_client(self, srv_name: str, policy: PolicyType=None, boxid: str=None, exclude: Iterable[str]=(), hash_key: Any=None) -> Optional[HttpClient]:
+        choose = self.get_policy(policy)
         connects = []
         cc = get_cluster()
         for bind in cc.route[srv_name]:
+            if bind in exclude:
+                continue
             if boxid:
                 box = cc.boxes.get(bind)
-                if box.boxid != boxid:
+                if not box or box['boxid'] != boxid:
                     continue
-            if policy == self.FIRST:
-                connects.append(bind)
-                break
-            else:
-                assert policy == self.RANDOM
-                connects.append(bind)
+            connects.append(bind)
 
         if connects:
-            connect = random.choice(connects)
-            return HttpClient(connect, expect='json')
+            now = time.time()
+            healthy = [bind for bind in connects
+                       if self.get_breaker(bind).available(now)]
+            if healthy:
+                # when every box is ejected try them all anyway
+                connects = healthy
+            if hash_key is not None:
+                connect = self.get_ring(srv_name).get(
+                    hash_key, allowed=set(connects))
+                assert connect is not None
+            else:
+                if self.locality:
+                    connects = self.prefer_local(connects)
+                connect = choose(connects, self.stats)
+            conn = self.get_connection(connect)
+            client = HttpClient(connect, expect='json',
+                                session=conn.session,
+                                codec=self.codec)
+            client.conn = conn
+            if self.transport == self.WEBSOCKET:
+                client.ws = conn.get_ws(client.url_prefix,
+                                        codec=self.codec)
+            return client
         return None
 
     def __getattr__(self, name: str) -> ServiceRef:
         return ServiceRef(name, self)
 
+    def batch(self) -> Batch:
+        return Batch(self)
+
     def __getitem__(self, name: str) -> ServiceRef:
         return ServiceRef(name, self)
 
-    async def request(self, srv_name: str, method: str, *params:Any, boxid: str=None, retry: int=0, req_id: Any=None, timeout: float=DEFAULT_TIMEOUT_SECS):
+    async def request(self, srv_name: str, method: str, *params:Any, boxid: str=None, retry: int=0, req_id: Any=None, timeout: float=DEFAULT_TIMEOUT_SECS, policy: PolicyType=None, hedge: HedgeType=None, hash_key: Any=None, priority: Optional[str]=None):
         if not req_id:
             req_id = next_request_id()
         req = Request.make(req_id, srv_name, method, *params)
-        return await self.request_obj(req, timeout=timeout, retry=retry)
+        req.priority = priority
+        return await self.request_obj(req, timeout=timeout, retry=retry,
+                                      boxid=boxid, policy=policy,
+                                      hedge=hedge, hash_key=hash_key)
+
+    async def stream(self, srv_name: str, method: str, *params: Any, boxid: str=None, req_id: Any=None, timeout: float=DEFAULT_TIMEOUT_SECS, policy: PolicyType=None, hash_key: Any=None, priority: Optional[str]=None) -> AsyncIterator[Any]:
+        '''
+        Iterate the items of a streaming method as they arrive, the
+        box produces them no faster than they are consumed.  timeout
+        bounds the wait for every item, not the whole stream
+        '''
+        # no item is waited for longer than the request being served
+        timeout = bbox_deadline.shrink_timeout(timeout)
+        if timeout <= 0:
+            raise asyncio.TimeoutError()
+        if not req_id:
+            req_id = next_request_id()
+        req = Request.make(req_id, srv_name, method, *params)
+        req.priority = priority or bbox_priority.inherited()
+
+        if has_service(srv_name):
+            sreq = ServiceRequest(req, deadline=time.time() + timeout,
+                                  stream=True)
+            resp = await sreq.handle()
+            result = resp.get('result')
+            if isinstance(result, StreamResult):
+                try:
+                    async for item in result:
+                        yield item
+                finally:
+                    await result.aclose()
+                return
+            lines: AsyncIterator[Dict[str, Any]] = aiter_list([resp])
+        else:
+            client = self.get_client(srv_name, boxid=boxid,
+                                     policy=policy, hash_key=hash_key)
+            if not client:
+                raise NoServiceFound('no service found {}'.format(srv_name))
+            lines = self._stream_client(client, req, timeout=timeout)
+
+        async for line in lines:
+            if 'item' in line:
+                yield line['item']
+                continue
+            error = line.get('error')
+            if error:
+                raise ServiceError(error.get('code'),
+                                   error.get('message'))
+            result = line.get('result')
+            if isinstance(result, list):
+                # collected by a box that does not stream
+                for item in result:
+                    yield item
+            return
+        raise ConnectionError(
+            'stream of {} ended early'.format(req.full_method))
+
+    async def request_obj(self, req, timeout=DEFAULT_TIMEOUT_SECS, retry=0, boxid=None, policy: PolicyType=None, hedge: HedgeType=None, hash_key: Any=None) -> Any:
+        # never wait longer than the request being served, if any
+        timeout = bbox_deadline.shrink_timeout(timeout)
+        if timeout <= 0:
+            raise asyncio.TimeoutError()
+        if req.priority is None:
+            req.priority = bbox_priority.inherited()
 
-    async def request_obj(self, req, timeout=DEFAULT_TIMEOUT_SECS, retry=0) -> Any:
         if has_service(req.srv_name):
             # if local has srv_name,
             # call it by default to avoid network failure
             #sreq = ServiceRequest.from_req(req)
-            sreq = ServiceRequest(req)
+            sreq = ServiceRequest(req, deadline=time.time() + timeout)
             return await sreq.handle()
 
+        cache_key = None
+        if (req.srv_name, req.method) in self.cache_ttls:
+            cache_key = self._cache_key(req)
+            stats_name = '/{}/{}'.format(req.srv_name, req.method)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                bbox_stats.client_cache_hit_count.incr(stats_name)
+                return dict(cached, id=req.req_id)
+            bbox_stats.client_cache_miss_count.incr(stats_name)
+
+        endpoint = (req.srv_name, req.method)
+        if hedge is None:
+            hedge = self.hedge_methods.get(endpoint)
+        self.hedge_budget.deposit()
+
+        start_time = time.time()
+        if hedge and not boxid:
+            # every attempt is a hedged pair
+            resp = await self._with_retry(
+                req.srv_name, retry, self._request_hedged,
+                req, self.hedge_delay(endpoint, hedge),
+                timeout=timeout, policy=policy, hash_key=hash_key)
+        else:
+            resp = await self._request_remote(
+                req, timeout=timeout, retry=retry,
+                boxid=boxid, policy=policy, hash_key=hash_key)
+        window = self.method_latency.get(endpoint)
+        if window is None:
+            window = LatencyWindow()
+            self.method_latency[endpoint] = window
+        window.add(time.time() - start_time)
+        self._cache_response(req, resp, cache_key=cache_key)
+        return resp
+
+    def set_hedge(self, srv_name: str, method: str, delay: HedgeType=True) -> None:
+        '''
+        Hedge every call of an idempotent method, after delay seconds
+        or after the observed p95 latency when delay is True
+        '''
+        self.hedge_methods[(srv_name, method)] = delay
+
+    def hedge_delay(self, endpoint: Tuple[str, str], hedge: HedgeType) -> float:
+        if hedge is not True:
+            return float(hedge)
+        window = self.method_latency.get(endpoint)
+        if window is None or len(window) < 10:
+            return DEFAULT_HEDGE_DELAY_SECS
+        return window.percentile(DEFAULT_HEDGE_PERCENTILE)
+
+    async def _request_hedged(self, req: Request, delay: float, timeout: float=DEFAULT_TIMEOUT_SECS, policy: PolicyType=None, hash_key: Any=None) -> Any:
+        '''
+        Send a second copy to another box when the first one is not
+        answered within delay seconds or fails before that, the first
+        answer wins.  Retry is raised when both copies could not
+        connect
+        '''
+        client = self.get_client(req.srv_name, policy=policy,
+                                 hash_key=hash_key)
+        if not client:
+            raise NoServiceFound('no service found {}'.format(req.srv_name))
+        first = asyncio.ensure_future(self._call_client(
+            client, client.request_obj, req, timeout=timeout))
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done and first.exception() is None:
+                return first.result()
+            if self.hedge_budget.withdraw():
+                hedge_client = self.get_client(
+                    req.srv_name, policy=policy,
+                    exclude=[client.connect],
+                    hash_key=hash_key)
+                if hedge_client:
+                    stats_name = '/{}/{}'.format(req.srv_name, req.method)
+                    bbox_stats.client_hedge_count.incr(stats_name)
+                    second = asyncio.ensure_future(self._call_client(
+                        hedge_client, hedge_client.request_obj,
+                        req, timeout=timeout))
+                    tasks.add(second)
+
+            error: Optional[BaseException] = None
+            while tasks:
+                done, tasks = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            bbox_stats.client_hedge_win_count.incr(
+                                '/{}/{}'.format(req.srv_name, req.method))
+                        return task.result()
+                    # a real error is more telling than a Retry
+                    if error is None or isinstance(error, Retry):
+                        error = task.exception()
+            assert error is not None
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _cache_key(self, req: Request) -> Tuple[str, str, str]:
+        return (req.srv_name, req.method, json_to_str(req.params))
+
+    def _cache_response(self, req: Request, resp: Any, cache_key: Any=None) -> None:
+        if not isinstance(resp, dict) or resp.get('error') is not None:
+            return
+        ttl = resp.get('cache_ttl')
+        if not ttl:
+            return
+        self.cache_ttls[(req.srv_name, req.method)] = ttl
+        self.cache.set(cache_key or self._cache_key(req), resp, ttl)
+
+    def invalidate(self, srv_name: str, method: str=None, *params: Any) -> int:
+        '''
+        Drop cached responses of a service, a method or one call
+        '''
+        if method is not None and params:
+            key = (srv_name, method, json_to_str(params))
+            if key in self.cache:
+                self.cache.delete(key)
+                return 1
+            return 0
+        return self.cache.delete_if(
+            lambda key: (key[0] == srv_name and
+                         (method is None or key[1] == method)))
+
+    async def discover_cache_hints(self, srv_name: str, timeout: float=DEFAULT_TIMEOUT_SECS) -> Dict[str, float]:
+        '''
+        Learn cache_ttl declarations from the __doc__ of a service
+        instead of waiting for the first response of each method
+        '''
+        r = await self.request(srv_name, '__doc__', timeout=timeout)
+        hints = {}
+        for mdoc in (r.get('result') or {}).get('methods', []):
+            ttl = mdoc.get('cache_ttl')
+            if ttl:
+                hints[mdoc['name']] = ttl
+                self.cache_ttls[(srv_name, mdoc['name'])] = ttl
+        return hints
+
+    async def _request_remote(self, req, timeout=DEFAULT_TIMEOUT_SECS, retry=0, boxid=None, policy: PolicyType=None, hash_key: Any=None) -> Any:
+        if self.batch_window > 0 and not boxid and hash_key is None:
+            return await self.auto_batcher.request_obj(
+                req, timeout=timeout, retry=retry, policy=policy)
+
+        return await self._with_retry(
+            req.srv_name, retry, self._request_obj,
+            req, boxid=boxid, timeout=timeout, policy=policy,
+            hash_key=hash_key)
+
+    def get_retry_budget(self, srv_name: str) -> RequestBudget:
+        budget = self.retry_budgets.get(srv_name)
+        if budget is None:
+            budget = RequestBudget(self.retry_ratio)
+            self.retry_budgets[srv_name] = budget
+        return budget
+
+    def retry_backoff(self, attempt: int, retry_after: Optional[float]=None) -> float:
+        '''
+        Full jitter exponential backoff, never shorter than the
+        retry_after hint of the server
+        '''
+        cap = min(RETRY_BACKOFF_MAX_SECS,
+                  RETRY_BACKOFF_BASE_SECS * (2 ** (attempt - 1)))
+        secs = random.uniform(0, cap)
+        if retry_after:
+            secs = max(secs, float(retry_after))
+        return secs
+
+    async def _with_retry(self, srv_name: str, retry: int, send: Any, *args: Any, **kw: Any) -> Any:
+        budget = self.get_retry_budget(srv_name)
+        budget.deposit()
+        retry_after = None
         for rty in range(retry + 1):
+            if rty > 0:
+                if not budget.withdraw():
+                    logger.warn('retry budget of %s exhausted', srv_name)
+                    break
+                await asyncio.sleep(self.retry_backoff(rty, retry_after))
             try:
-                return await self._request_obj(
-                    req,
-                    boxid=None,
-                    timeout=timeout)
+                resp = await send(*args, **kw)
             except Retry:
+                retry_after = None
                 continue
+            retry_after = get_retry_after(resp)
+            if retry_after is None or rty >= retry:
+                return resp
+        if retry_after is not None:
+            # the server kept asking to back off, hand its error over
+            return resp
         raise ConnectionError(
             'cannot retry connections')
 
-    async def _request_obj(self, req, boxid=None, timeout=DEFAULT_TIMEOUT_SECS) -> Any:
-        client = self.get_client(req.srv_name, boxid=boxid)
+    async def request_batch(self, reqs: List[Request], timeout: float=DEFAULT_TIMEOUT_SECS, retry: int=0, policy: PolicyType=None) -> List[Dict[str, Any]]:
+        '''
+        Send the requests as one JSON-RPC batch per service and
+        return the responses in the order of reqs, a failed entry
+        carries its own error
+        '''
+        # never wait longer than the request being served, if any
+        timeout = bbox_deadline.shrink_timeout(timeout)
+        if timeout <= 0:
+            raise asyncio.TimeoutError()
+        groups: Dict[str, List[int]] = {}
+        for i, req in enumerate(reqs):
+            groups.setdefault(req.srv_name, []).append(i)
+
+        results: List[Dict[str, Any]] = [{} for _ in reqs]
+        async def run_group(srv_name: str, indices: List[int]) -> None:
+            batch = BatchRequest([reqs[i] for i in indices])
+            try:
+                resps = await self._request_group(
+                    srv_name, batch,
+                    timeout=timeout, retry=retry, policy=policy)
+            except Exception as e:
+                # one unreachable service fails its own entries only
+                logger.warn('batch to %s failed', srv_name, exc_info=True)
+                resps = batch.error_responses(e)
+            for i, resp in zip(indices, resps):
+                results[i] = resp
+
+        await asyncio.gather(
+            *[run_group(srv_name, indices)
+              for srv_name, indices in groups.items()])
+        return results
+
+    async def _request_group(self, srv_name: str, batch: BatchRequest, timeout: float=DEFAULT_TIMEOUT_SECS, retry: int=0, policy: PolicyType=None) -> List[Dict[str, Any]]:
+        if has_service(srv_name):
+            deadline = time.time() + timeout
+            return await asyncio.gather(
+                *[ServiceRequest(req, deadline=deadline).handle()
+                  for req in batch.reqs])
+
+        return await self._with_retry(
+            srv_name, retry, self._request_batch,
+            srv_name, batch, timeout=timeout, policy=policy)
+
+    async def _request_batch(self, srv_name: str, batch: BatchRequest, timeout: float=DEFAULT_TIMEOUT_SECS, policy: PolicyType=None) -> List[Dict[str, Any]]:
+        client = self.get_client(srv_name, policy=policy)
+        if not client:
+            raise NoServiceFound('no service found {}'.format(srv_name))
+        return await self._call_client(
+            client, client.request_batch, batch, timeout=timeout)
+
+    async def _request_obj(self, req, boxid=None, timeout=DEFAULT_TIMEOUT_SECS, policy: PolicyType=None, hash_key: Any=None) -> Any:
+        client = self.get_client(req.srv_name, boxid=boxid, policy=policy,
+                                 hash_key=hash_key)
         if not client:
             raise NoServiceFound('no service found {}'.format(req.srv_name))
             #raise ConnectionError(
             #   'no available rpc server for {}'.format(req.srv_name))
+        return await self._call_client(
+            client, client.request_obj, req, timeout=timeout)
+
+    async def _stream_client(self, client: HttpClient, req: Request, timeout: float=DEFAULT_TIMEOUT_SECS) -> AsyncIterator[Dict[str, Any]]:
+        start_time = self._start_call(client)
+        ok = False
+        failed = False
         try:
-            return await client.request_obj(
-                req, timeout=timeout)
-        except ConnectionError:
-            #assert not client.
+            async for line in client.stream_obj(req, timeout=timeout):
+                # the box is answering, whatever happens to the stream
+                ok = True
+                yield line
+        except Exception:
+            failed = not ok
+            raise
+        finally:
+            await self._finish_call(client, start_time, ok, failed)
+
+    def _start_call(self, client: HttpClient) -> float:
+        if client.conn is not None:
+            client.conn.acquire()
+        self.get_breaker(client.connect).on_request()
+        return self.get_stats(client.connect).start()
+
+    async def _call_client(self, client: HttpClient, send: Any, *args: Any, **kw: Any) -> Any:
+        start_time = self._start_call(client)
+        ok = False
+        failed = False
+        try:
+            resp = await send(*args, **kw)
+            ok = True
+            return resp
+        except (ConnectionError, aiohttp.ClientConnectionError):
+            # the next attempt may pick another box
+            failed = True
+            conn = client.conn
+            if conn is not None and conn.unix_path:
+                # a stale socket file stays on disk, fall back to TCP
+                self.failed_unix[conn.bind] = conn.unix_path
+                self._discard_connection(conn)
             raise Retry()
+        except Exception:
+            failed = True
+            raise
         finally:
-            await client.close()
+            await self._finish_call(client, start_time, ok, failed)
+
+    async def _finish_call(self, client: HttpClient, start_time: float, ok: bool, failed: bool) -> None:
+        stats = self.get_stats(client.connect)
+        breaker = self.get_breaker(client.connect)
+        stats.finish(start_time, ok=ok)
+        if ok:
+            breaker.record_success()
+        elif failed:
+            was_open = breaker.state == breaker.OPEN
+            breaker.record_failure()
+            if not was_open and breaker.state == breaker.OPEN:
+                bbox_stats.client_breaker_trip_count.incr(
+                    client.connect)
+        else:
+            breaker.record_cancel()
+        if client.conn is not None:
+            # the connection may have left the pool meanwhile and is
+            # waiting for its calls to drain
+            client.conn.release()
+        await client.close()
+
+_pools: 'weakref.WeakSet[SimpleHttpPool]' = weakref.WeakSet()
+
+class BreakerStateMetrics(IMetricsEntry):
+    name = 'rpc_client_breaker_state'
+    help = 'RPC client circuit breaker state, 0 closed, 1 half open, 2 open'
+    type = 'gauge'
+
+    async def collect(self) -> List[MEntry]:
+        arr: List[MEntry] = []
+        for p in list(_pools):
+            for bind, breaker in p.breakers.items():
+                arr.append(({'bind': bind}, breaker.state_value()))
+        return arr
+
+add_metrics(BreakerStateMetrics())
 
 pool = SimpleHttpPool()
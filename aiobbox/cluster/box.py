@@ -1,5 +1,6 @@
 from typing import Dict, Any, List, Union, Iterable, Set, Optional
 import logging
+import os
 import re
 import json
 import time
@@ -21,6 +22,7 @@ BOX_TTL = 6
 
 class BoxAgent:
     srv_names: List[str]
+    boxid: str = ''
     bind: str = ''
     extbind: str = ''
     etcd_client: EtcdClient
@@ -31,6 +33,9 @@ class BoxAgent:
         self.started: bool = False
         self.etcd_client = EtcdClient()
         self.override_ticket: Dict[str, Any] = {}
+        self.zone: str = ''
+        # unix socket served besides the TCP bind, for same host callers
+        self.unix_path: str = ''
 
     def set_cont(self, cont: bool) -> None:
         self.etcd_client.cont = cont
@@ -47,6 +52,7 @@ class BoxAgent:
         self.bind = f'0.0.0.0:{port}'
         self.extbind = static_box['bind']
         self.ssl_prefix = static_box.get("ssl_prefix")
+        self.zone = static_box.get('zone', '')
 
         self.etcd_client.connect()
         await self.register()
@@ -90,6 +96,8 @@ class BoxAgent:
             'start_time': datetime.now(tzlocal()),
             'ssl': self.ssl_prefix,
             'boxid': self.boxid,
+            'zone': self.zone,
+            'unix': self.unix_path,
             'services': self.srv_names})
 
     def get_box_config(self, key: str, default:Any=None) -> Any:
@@ -112,6 +120,8 @@ class BoxAgent:
         if self.override_ticket.get('extbind'):
             ticket.extbind = self.override_ticket['extbind']
 
+        self.zone = self.get_box_config('zone', default=ticket.zone)
+
         for retry_t in range(retry + 1):
             if self.bind:
                 return
@@ -169,6 +179,8 @@ class BoxAgent:
             await self.etcd_client.delete(key)
         except ETCDError:
             pass
+        if self.unix_path and os.path.exists(self.unix_path):
+            os.unlink(self.unix_path)
         logging.info('box %s deregistered from cluster', self.boxid)
 
     # async def update(self, key: str) -> None:
@@ -11,6 +11,7 @@ import asyncio
 import aiohttp
 from collections import defaultdict
 from aiobbox.utils import json_to_str, localbox_ip, force_str, get_bbox_path
+from aiobbox import codecs
 from aiobbox.exceptions import RegisterFailed, ETCDError
 from .etcd_client import EtcdClient
 
@@ -76,6 +77,7 @@ class ClientAgent:
                 'start_time': datetime.now(tzlocal()).replace(microsecond=0).isoformat(),
                 'ssl': sbox.get('ssl_prefix'),
                 'boxid': boxid,
+                'zone': sbox.get('zone', ''),
                 'services': sbox['services'],
             }
 
@@ -86,7 +88,7 @@ class ClientAgent:
                     continue
                 if not v.value:
                     continue
-                box_info = json.loads(v.value)
+                box_info = codecs.loads(v.value)
                 bind = box_info['bind']
                 boxes[bind] = box_info
                 for srv in box_info['services']:
@@ -198,7 +200,7 @@ class ClientAgent:
                 assert m.group('prefix') == self.etcd_client.prefix
                 sec = m.group('sec')
                 key = m.group('key')
-                new_conf.set(sec, key, json.loads(v.value))
+                new_conf.set(sec, key, codecs.loads(v.value))
 
         curr_conf = get_sharedconfig()
         delete_set, add_set = curr_conf.compare_sections(
@@ -15,6 +15,8 @@ class Ticket:
     language: str = 'python3'
     etcd: List[str] = []
     extbind: str = ''
+    # zone/rack label advertised in the box info for locality routing
+    zone: str = ''
     port_range = List[int]
     loadtime: int
 
@@ -34,6 +36,7 @@ class Ticket:
                 self.language = kw.get('language', 'python3')
                 self.etcd = kw['etcd']
                 self.extbind = kw.get('extbind', '')
+                self.zone = kw.get('zone', '')
                 self.loadtime = int(time.time())
 
                 self.validate()
@@ -0,0 +1,114 @@
+from typing import Dict, Any, List, Optional
+import logging
+from json import dumps as json_dumps, loads as json_loads
+from aiobbox.utils import BBoxJSONEncoder, json_default
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger('bbox')
+
+JSON_CONTENT_TYPE = 'application/json'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+# streamed results, one JSON object per line
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+class Codec:
+    name: str = ''
+    content_type: str = ''
+    binary: bool = False
+
+    def encode(self, obj: Any) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, data: bytes) -> Any:
+        raise NotImplementedError
+
+class JSONCodec(Codec):
+    '''
+    JSON through orjson when importable, the stdlib json otherwise
+    or when orjson cannot handle a value, e.g. very big integers
+    '''
+    name = 'json'
+    content_type = JSON_CONTENT_TYPE
+
+    def encode(self, obj: Any) -> bytes:
+        if orjson is not None:
+            try:
+                return orjson.dumps(
+                    obj, default=json_default,
+                    option=(orjson.OPT_PASSTHROUGH_DATETIME |
+                            orjson.OPT_NON_STR_KEYS))
+            except TypeError:
+                pass
+        return json_dumps(obj, cls=BBoxJSONEncoder).encode('utf-8')
+
+    def decode(self, data: bytes) -> Any:
+        if orjson is not None:
+            try:
+                return orjson.loads(data)
+            except ValueError:
+                pass
+        return json_loads(data)
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+    content_type = MSGPACK_CONTENT_TYPE
+    binary = True
+
+    def encode(self, obj: Any) -> bytes:
+        return msgpack.packb(obj, default=json_default,
+                             use_bin_type=True)
+
+    def decode(self, data: bytes) -> Any:
+        return msgpack.unpackb(data, raw=False,
+                               strict_map_key=False)
+
+json_codec = JSONCodec()
+
+_codecs: Dict[str, Codec] = {}
+
+def add_codec(codec: Codec) -> None:
+    _codecs[codec.name] = codec
+    _codecs[codec.content_type] = codec
+
+add_codec(json_codec)
+if msgpack is not None:
+    add_codec(MsgpackCodec())
+
+def get_codec(name: Optional[str]) -> Codec:
+    '''
+    Codec by name or content type, JSON when unknown or missing
+    '''
+    if not name:
+        return json_codec
+    name = name.split(';', 1)[0].strip().lower()
+    return _codecs.get(name, json_codec)
+
+def has_codec(name: str) -> bool:
+    return name in _codecs
+
+def negotiate(accept: Optional[str], default: Codec=json_codec) -> Codec:
+    '''
+    The first available codec listed in an Accept header
+    '''
+    if not accept:
+        return default
+    for part in accept.split(','):
+        ctype = part.split(';', 1)[0].strip().lower()
+        if ctype in _codecs:
+            return _codecs[ctype]
+    return default
+
+def dumps(obj: Any) -> str:
+    return json_codec.encode(obj).decode('utf-8')
+
+def loads(data: Any) -> Any:
+    return json_codec.decode(data)
@@ -0,0 +1,70 @@
+from typing import Optional, Tuple
+import os
+import time
+import gzip
+import zlib
+from aiohttp import web
+from aiobbox import stats
+
+# bodies smaller than this are sent as is, a negative value disables
+# compression
+COMPRESS_MIN_SIZE = int(os.getenv('BBOX_COMPRESS_MIN_SIZE', '4096'))
+COMPRESS_LEVEL = 6
+
+SUPPORTED_ENCODINGS = ('gzip', 'deflate')
+
+# response header telling the client it may compress request bodies
+ACCEPT_HEADER = 'X-Bbox-Accept-Encoding'
+ACCEPT_VALUE = ', '.join(SUPPORTED_ENCODINGS)
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    '''
+    The preferred supported encoding of an Accept-Encoding header
+    '''
+    if not accept_encoding:
+        return None
+    accepted = set()
+    for part in accept_encoding.split(','):
+        items = [v.strip() for v in part.split(';')]
+        enc = items[0].lower()
+        if any(v.replace(' ', '') in ('q=0', 'q=0.0') for v in items[1:]):
+            continue
+        accepted.add(enc)
+    for enc in SUPPORTED_ENCODINGS:
+        if enc in accepted:
+            return enc
+    return None
+
+def compress_body(body: bytes, accept_encoding: Optional[str], stats_name: str) -> Tuple[bytes, Optional[str]]:
+    '''
+    Compress body when it is large enough and the peer accepts an
+    encoding, return the body and the encoding used, if any
+    '''
+    if COMPRESS_MIN_SIZE < 0 or len(body) < COMPRESS_MIN_SIZE:
+        return body, None
+    encoding = choose_encoding(accept_encoding)
+    if encoding is None:
+        return body, None
+
+    start_time = time.time()
+    if encoding == 'gzip':
+        data = gzip.compress(body, compresslevel=COMPRESS_LEVEL)
+    else:
+        data = zlib.compress(body, COMPRESS_LEVEL)
+    stats.compress_seconds.incr(stats_name, time.time() - start_time)
+    stats.compress_saved_bytes.incr(stats_name, len(body) - len(data))
+    return data, encoding
+
+def make_response(request: web.Request, body: bytes, content_type: str, charset: Optional[str]=None) -> web.Response:
+    '''
+    A response compressed as the request accepts, it also tells the
+    client that request bodies may be compressed
+    '''
+    body, encoding = compress_body(
+        body, request.headers.get('Accept-Encoding'), request.path)
+    headers = {ACCEPT_HEADER: ACCEPT_VALUE,
+               'Vary': 'Accept-Encoding'}
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return web.Response(body=body, content_type=content_type,
+                        charset=charset, headers=headers)
@@ -1,5 +1,82 @@
+from typing import Dict, Any, Tuple
+import re
+import time
+from hashlib import sha256
 from aiobbox.cluster import get_sharedconfig
+from aiobbox.cache import LRUCache
+from aiobbox.exceptions import ServiceError
+
+DEFAULT_TOKEN_CACHE_SIZE = 10000
+
+# token -> (seed, verify result), entries expire with the token
+_verified = LRUCache(DEFAULT_TOKEN_CACHE_SIZE)
 
 def has_consumer(consumer):
     cfg = get_sharedconfig()
     return cfg.has_key('consumers', consumer)
+
+def get_consumer(consumer: str) -> Dict[str, Any]:
+    '''
+    The options of a consumer, other keys of the consumers section
+    such as allow_create are not consumers
+    '''
+    coptions = get_sharedconfig().get('consumers', consumer)
+    if not isinstance(coptions, dict) or 'seed' not in coptions:
+        raise ServiceError('consumer not found')
+    return coptions
+
+def token_digest(consumer: str, expire_at: str, nonce: str, seed: str) -> str:
+    digest_src = ':'.join([
+        consumer, expire_at,
+        nonce, seed])
+    m = sha256()
+    m.update(digest_src.encode('utf-8'))
+    return m.hexdigest()
+
+def parse_token(token: Any) -> Tuple[str, str, str, str]:
+    if not isinstance(token, str):
+        raise ServiceError('invalid token')
+    arr = token.split(':')
+    if len(arr) != 4 or re.search(r'\s', token):
+        raise ServiceError('invalid token',
+                           'token {}'.format(token))
+    consumer, expire_at, nonce, digest = arr
+    return consumer, expire_at, nonce, digest
+
+def verify_token(token: Any) -> Dict[str, Any]:
+    '''
+    Verify a token in process against the consumers config, it
+    raises the same errors as bbox.consumer::verifyToken.  Verified
+    tokens are remembered until they expire or the seed of their
+    consumer changes
+    '''
+    consumer, expire_at, nonce, digest = parse_token(token)
+    coptions = get_consumer(consumer)
+
+    try:
+        expire_ts = int(expire_at)
+    except ValueError:
+        raise ServiceError('invalid token',
+                           'token {}'.format(token))
+    now = time.time()
+    if expire_ts < now:
+        raise ServiceError('token expired')
+
+    seed = coptions['seed']
+    cached = _verified.get(token)
+    if cached is not None:
+        cached_seed, result = cached
+        if cached_seed == seed:
+            return dict(result)
+        _verified.delete(token)
+
+    if token_digest(consumer, expire_at, nonce, seed) != digest:
+        raise ServiceError('verify failed')
+
+    result = {
+        'consumer': consumer,
+        'expire_at': expire_at,
+        'verified': True
+        }
+    _verified.set(token, (seed, result), ttl=expire_ts - now)
+    return dict(result)
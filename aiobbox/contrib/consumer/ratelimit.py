@@ -0,0 +1,176 @@
+'''
+Rate limits of consumers, GCRA with the rate in calls per second and
+the burst of calls allowed at once given per consumer in the consumers
+config section, the limit of consumers without one and the redis
+counting calls cluster wide are in the rate_limits section, e.g.
+
+    "consumers": {
+        "foo": {"secret": ..., "seed": ...,
+                "rate_limit": {"rate": 10, "burst": 20}}
+    },
+    "rate_limits": {
+        "default": {"rate": 100, "burst": 100},
+        "redis": "redis://127.0.0.1:6379"
+    }
+
+Calls are counted in process, and cluster wide in redis when it is
+set.  Only consumers of tokens that verify are charged.
+'''
+from typing import Dict, Any, Optional, Tuple, Callable
+import time
+import math
+import logging
+from functools import wraps
+from aiohttp import web
+from aiobbox.cluster import get_sharedconfig
+from aiobbox.exceptions import RateLimited, ServiceError
+from .helpers import verify_token
+
+logger = logging.getLogger('bbox')
+
+KEY_PREFIX = 'bbox.ratelimit.'
+
+# GCRA on the theoretical arrival time stored in KEYS[1],
+# ARGV is now, the emission interval and the tolerance,
+# returns the seconds to wait, 0 when the call is allowed
+GCRA_SCRIPT = '''
+local now = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local tolerance = tonumber(ARGV[3])
+local tat = now
+local stored = redis.call('GET', KEYS[1])
+if stored then
+    tat = math.max(tonumber(stored), now)
+end
+if tat - now > tolerance then
+    return tostring(tat - now - tolerance)
+end
+local ttl = math.ceil((tat + interval - now) * 1000)
+redis.call('SET', KEYS[1], tostring(tat + interval), 'PX', ttl)
+return '0'
+'''
+
+def get_rate_limit(consumer: str) -> Optional[Tuple[float, int]]:
+    '''
+    rate and burst of a consumer, None if it is not limited
+    '''
+    cfg = get_sharedconfig()
+    coptions = cfg.get('consumers', consumer)
+    limit = None
+    if isinstance(coptions, dict):
+        limit = coptions.get('rate_limit')
+    if not limit:
+        limit = cfg.get('rate_limits', 'default')
+    if not isinstance(limit, dict) or not limit.get('rate'):
+        return None
+    rate = float(limit['rate'])
+    return rate, int(limit.get('burst', max(1, rate)))
+
+def gcra(tat: Optional[float], now: float, rate: float, burst: int) -> Tuple[float, float]:
+    '''
+    The new theoretical arrival time and the seconds to wait, 0 when
+    the call is allowed
+    '''
+    interval = 1.0 / rate
+    tolerance = (burst - 1) * interval
+    tat = max(tat or now, now)
+    if tat - now > tolerance:
+        return tat, tat - now - tolerance
+    return tat + interval, 0
+
+class RateLimiter:
+    def __init__(self, redis_url: Optional[str]=None) -> None:
+        # redis_url overrides the redis of the rate_limits config
+        self.redis_url = redis_url
+        self.tats: Dict[str, float] = {}
+
+    def check_local(self, consumer: str, rate: float, burst: int) -> float:
+        now = time.time()
+        tat, wait = gcra(self.tats.get(consumer), now, rate, burst)
+        self.tats[consumer] = tat
+        return wait
+
+    async def check_cluster(self, consumer: str, rate: float, burst: int) -> float:
+        redis_url = self.redis_url or get_sharedconfig().get(
+            'rate_limits', 'redis')
+        if not redis_url:
+            return 0
+        from aiobbox.contrib.redis import get_pool
+        interval = 1.0 / rate
+        try:
+            redis_pool = await get_pool(redis_url)
+            wait = await redis_pool.execute(
+                'EVAL', GCRA_SCRIPT, 1, KEY_PREFIX + consumer,
+                repr(time.time()), repr(interval),
+                repr((burst - 1) * interval))
+        except Exception:
+            # the local limit still holds, fail open
+            logger.warn('cannot check rate limit of %s in redis',
+                        consumer, exc_info=True)
+            return 0
+        return float(wait)
+
+    async def check(self, consumer: str) -> None:
+        '''
+        Count a call of consumer, raise RateLimited if it is over
+        the limit
+        '''
+        limit = get_rate_limit(consumer)
+        if limit is None:
+            return
+        rate, burst = limit
+        wait = self.check_local(consumer, rate, burst)
+        if wait <= 0:
+            wait = await self.check_cluster(consumer, rate, burst)
+        if wait > 0:
+            raise RateLimited(
+                'consumer {} is over {} calls per second'.format(
+                    consumer, rate),
+                retry_after=wait)
+
+limiter = RateLimiter()
+
+async def check_request(request: web.Request) -> Optional[web.Response]:
+    '''
+    For HTTP frontends, a 429 response when the consumer of the
+    X-Bbox-Token header is over its limit
+    '''
+    consumer = token_consumer(request.headers.get('X-Bbox-Token'))
+    if not consumer:
+        return None
+    try:
+        await limiter.check(consumer)
+    except RateLimited as e:
+        return web.Response(
+            status=429, text=str(e),
+            headers={'Retry-After': str(math.ceil(e.retry_after))})
+    return None
+
+def token_consumer(token: Any) -> Optional[str]:
+    '''
+    The consumer of a valid token, None for anything else so that
+    forged tokens cannot use up the limit of another consumer
+    '''
+    try:
+        return verify_token(token)['consumer']
+    except ServiceError:
+        return None
+
+def rate_limit(consumer_of: Callable[..., Optional[str]]=None) -> Callable:
+    '''
+    Decorate a service method to reject calls over the rate limit of
+    their consumer, named by consumer_of(request, *params), by default
+    the consumer of the token passed as the first param
+    '''
+    def decorator(fn: Callable) -> Callable:
+        @wraps(fn)
+        async def wrapper(request, *params):
+            if consumer_of is not None:
+                consumer = consumer_of(request, *params)
+            else:
+                consumer = token_consumer(params[0]) if params else None
+            if consumer:
+                await limiter.check(consumer)
+            return await fn(request, *params)
+        return wrapper
+    return decorator
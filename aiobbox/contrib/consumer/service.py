@@ -2,12 +2,14 @@ import time
 import ssl
 import re
 import uuid
-from hashlib import sha256
 from aiobbox import testing
 from aiobbox.server import Service
 from aiobbox.cluster import get_cluster
 from aiobbox.exceptions import ServiceError
 from aiobbox.cluster import get_sharedconfig
+from .helpers import verify_token, token_digest, get_consumer
+
+MAX_VERIFY_TOKENS = 1000
 
 srv = Service()
 srv.__doc__ = '''
@@ -65,15 +67,12 @@ async def create_consumer_token(request, consumer, secret, options=None):
     if not isinstance(consumer, str):
         raise ServiceError('invalid consumer')
     options = options or {}
-    cfg = get_sharedconfig()
-    coptions = cfg.get('consumers', consumer)
-    if not coptions:
-        raise ServiceError('consumer not found')
+    coptions = get_consumer(consumer)
 
     if not isinstance(secret, str):
         raise ServiceError('invalid secret')
 
-    if coptions['secret'] != secret:
+    if coptions.get('secret') != secret:
         raise ServiceError('consumer verify failed')
 
     expire_in = int(options.get('expire_in', 3 * 365 * 86400))
@@ -82,12 +81,8 @@ async def create_consumer_token(request, consumer, secret, options=None):
 
     expire_at = int(time.time() + expire_in)
     nonce = uuid.uuid4().hex
-    digest_src = ':'.join([
-        consumer, str(expire_at),
-        nonce, coptions['seed']])
-    m = sha256()
-    m.update(digest_src.encode('utf-8'))
-    digest = m.hexdigest()
+    digest = token_digest(consumer, str(expire_at),
+                          nonce, coptions['seed'])
     token = ':'.join([consumer,
                       str(expire_at),
                       nonce, digest])
@@ -103,33 +98,30 @@ async def verify_consumer_token(request, token):
     verifyToken(token)
     verify a token, it may be invalid or expired
     '''
-    arr = token.split(':')
-    if len(arr) != 4 or re.search(r'\s', token):
-        raise ServiceError('invalid token',
-                           'token {}'.format(token))
-
-    consumer, expire_at, nonce, digest = arr
-    cfg = get_sharedconfig()
-    coptions = cfg.get('consumers', consumer)
-    if not coptions:
-        raise ServiceError('consumer not found')
-
-    if int(expire_at) < time.time():
-        raise ServiceError('token expired')
+    return verify_token(token)
 
-    digest_src = ':'.join([
-        consumer, expire_at,
-        nonce, coptions['seed']])
-    m = sha256()
-    m.update(digest_src.encode('utf-8'))
-    new_digest = m.hexdigest()
-    if new_digest != digest:
-        raise ServiceError('verify failed')
-
-    return {
-        'consumer': consumer,
-        'expire_at': expire_at,
-        'verified': True
-        }
+@srv.method('verifyTokens')
+async def verify_consumer_tokens(request, tokens):
+    '''
+    verifyTokens(tokens)
+    verify many tokens at once, each result is either the one of
+    verifyToken or {"verified": false, "code": ..., "message": ...}
+    '''
+    if not isinstance(tokens, list):
+        raise ServiceError('invalid tokens')
+    if len(tokens) > MAX_VERIFY_TOKENS:
+        raise ServiceError('too many tokens',
+                           'at most {} tokens'.format(MAX_VERIFY_TOKENS))
+    results = []
+    for token in tokens:
+        try:
+            results.append(verify_token(token))
+        except ServiceError as e:
+            results.append({
+                'verified': False,
+                'code': e.code,
+                'message': str(e)
+            })
+    return results
 
 srv.register('bbox.consumer')
@@ -9,7 +9,8 @@ import ssl
 from urllib.parse import urlparse, parse_qs
 from argparse import Namespace
 from aiobbox.jsonrpc import Request
-from aiobbox.utils import json_to_str, get_ssl_context, localbox_ip
+from aiobbox.utils import get_ssl_context, localbox_ip
+from aiobbox import codecs
 from aiobbox.cluster import get_cluster, get_box
 from aiobbox.client import DEFAULT_TIMEOUT_SECS
 from aiobbox.client import pool as srv_pool
@@ -56,7 +57,7 @@ class RedisTunnel:
         redis_pool = await self.get_redis_pool()
         await redis_pool.execute('LPUSH',
                                  self.req_key,
-                                 json_to_str(payload))
+                                 codecs.dumps(payload))
         # wait for response
         res_key = 'tunnel.res.{}'.format(tmp_req_id)
         # TODO: timeout
@@ -64,7 +65,7 @@ class RedisTunnel:
             'BRPOP', res_key, timeout)
         if r is not None:
             key, res = r
-            res = json.loads(res)
+            res = codecs.loads(res)
             res['id'] = req.req_id
             return res
         else:
@@ -77,7 +78,7 @@ class RedisTunnel:
             key, body = await redis_pool.execute(
                 'BRPOP', self.req_key, 0)
             logging.debug('brpoped %s %s', key, body)
-            body = json.loads(body)
+            body = codecs.loads(body)
             if parallel:
                 asyncio.ensure_future(self.handle_req(body))
             else:
@@ -108,7 +109,7 @@ class RedisTunnel:
         redis_pool = await self.get_redis_pool()
         if req.req_id:
             res_key = 'tunnel.res.{}'.format(req.req_id)
-            await redis_pool.execute('LPUSH', res_key, json_to_str(res))
+            await redis_pool.execute('LPUSH', res_key, codecs.dumps(res))
             await redis_pool.execute('EXPIRE', res_key, timeout)
 
     async def start_proxy_server(self, args:Namespace) -> None:
@@ -0,0 +1,37 @@
+from typing import Optional
+import time
+from contextvars import ContextVar, Token
+
+# absolute time.time() the current request must be answered by,
+# nested pool calls made while serving it shrink their timeouts to it
+_deadline: ContextVar[Optional[float]] = ContextVar(
+    'bbox_deadline', default=None)
+
+def get_deadline() -> Optional[float]:
+    return _deadline.get()
+
+def set_deadline(deadline: Optional[float]) -> Token:
+    curr = _deadline.get()
+    if curr is not None and deadline is not None:
+        deadline = min(curr, deadline)
+    elif deadline is None:
+        deadline = curr
+    return _deadline.set(deadline)
+
+def reset_deadline(token: Token) -> None:
+    _deadline.reset(token)
+
+def remaining() -> Optional[float]:
+    '''
+    Seconds left before the current deadline, None without deadline
+    '''
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+def shrink_timeout(timeout: float) -> float:
+    left = remaining()
+    if left is None:
+        return timeout
+    return min(timeout, left)
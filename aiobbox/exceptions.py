@@ -27,3 +27,21 @@ class ServiceError(Exception):
         self.code = code
         super(ServiceError, self).__init__(msg or code)
 
+
+class ServiceOverloaded(ServiceError):
+    '''
+    The box cannot take the request now, retry_after tells the
+    caller how many seconds to back off
+    '''
+    def __init__(self, msg=None, retry_after=None):
+        super(ServiceOverloaded, self).__init__('overloaded', msg)
+        self.retry_after = retry_after
+
+class RateLimited(ServiceError):
+    '''
+    The consumer calls more often than its rate limit allows,
+    retry_after tells the caller how many seconds until it may
+    '''
+    def __init__(self, msg=None, retry_after=None):
+        super(RateLimited, self).__init__('rate limited', msg)
+        self.retry_after = retry_after
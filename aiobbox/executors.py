@@ -0,0 +1,108 @@
+'''
+Managed pools running the synchronous service methods declared with
+an executor, so that CPU bound work stays off the event loop
+'''
+from typing import Dict, Any, List, Callable, Optional, Set
+import os
+import asyncio
+import logging
+import importlib
+import contextvars
+from functools import partial
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from aiobbox import stats
+
+logger = logging.getLogger('bbox')
+
+EXECUTOR_KINDS = ('thread', 'process')
+
+# pool sizes, 0 picks the default of concurrent.futures
+THREAD_WORKERS = int(os.getenv('BBOX_THREAD_WORKERS', '0'))
+PROCESS_WORKERS = int(os.getenv('BBOX_PROCESS_WORKERS', '0'))
+
+# modules of the methods run in the process pool, imported by every
+# pool process before its first call so the services are registered
+_process_modules: Set[str] = set()
+
+def add_process_module(module: str) -> None:
+    _process_modules.add(module)
+
+def init_process(modules: List[str]) -> None:
+    for module in modules:
+        importlib.import_module(module)
+
+class ManagedExecutor:
+    '''
+    A lazily created pool of one kind, it counts the calls submitted
+    and not yet done to report the queue depth and the utilization
+    '''
+    def __init__(self, kind: str, max_workers: int=0) -> None:
+        assert kind in EXECUTOR_KINDS
+        self.kind = kind
+        if max_workers <= 0:
+            cpus = os.cpu_count() or 1
+            max_workers = min(32, cpus + 4) if kind == 'thread' else cpus
+        self.max_workers = max_workers
+        self.pending = 0
+        self.pool: Optional[Executor] = None
+
+    def get_pool(self) -> Executor:
+        if self.pool is None:
+            if self.kind == 'thread':
+                self.pool = ThreadPoolExecutor(
+                    self.max_workers,
+                    thread_name_prefix='bbox-executor')
+            else:
+                self.pool = ProcessPoolExecutor(
+                    self.max_workers,
+                    initializer=init_process,
+                    initargs=(sorted(_process_modules),))
+        return self.pool
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        loop = asyncio.get_event_loop()
+        if self.kind == 'thread':
+            # the deadline and the priority are visible in the thread
+            call = partial(contextvars.copy_context().run, fn, *args)
+        else:
+            call = partial(fn, *args)
+        self.pending += 1
+        self.report()
+        try:
+            return await loop.run_in_executor(self.get_pool(), call)
+        except BrokenProcessPool:
+            logger.warn('process pool broken, a new one will be started')
+            self.shutdown(wait=False)
+            raise
+        finally:
+            self.pending -= 1
+            self.report()
+
+    def report(self) -> None:
+        busy = min(self.pending, self.max_workers)
+        stats.executor_queued_gauge.setv(
+            self.kind, self.pending - busy)
+        stats.executor_utilization_gauge.setv(
+            self.kind, busy / self.max_workers)
+
+    def shutdown(self, wait: bool=True) -> None:
+        pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait)
+
+_executors: Dict[str, ManagedExecutor] = {}
+
+def get_executor(kind: str) -> ManagedExecutor:
+    executor = _executors.get(kind)
+    if executor is None:
+        if kind == 'thread':
+            executor = ManagedExecutor(kind, THREAD_WORKERS)
+        else:
+            executor = ManagedExecutor(kind, PROCESS_WORKERS)
+        _executors[kind] = executor
+    return executor
+
+def shutdown_executors(wait: bool=True) -> None:
+    for executor in _executors.values():
+        executor.shutdown(wait=wait)
@@ -1,6 +1,7 @@
 from typing import Dict, Any, List, Tuple, Union, Iterable, Optional
 import re
-from aiobbox.exceptions import DataError
+import asyncio
+from aiobbox.exceptions import DataError, NoServiceFound, ServiceError
 
 def parse_method(method):
     return re.match(
@@ -11,6 +12,7 @@ ParamsType = Union[List[Any], Tuple[Any, ...]]
 
 class Request:
     req_id: Any = None
+    priority: Optional[str] = None
     params: ParamsType
     srv_name: str
     method: str
@@ -49,6 +51,8 @@ class Request:
         }
         if self.req_id is not None:
             data['id'] = self.req_id
+        if self.priority is not None:
+            data['priority'] = self.priority
         return data
 
     def _parse_body(self, body: Dict[str, Any]) -> None:
@@ -74,6 +78,11 @@ class Request:
         self.srv_name = m.group('srv')
         self.method = m.group('method')
 
+        priority = body.get('priority')
+        if not (priority is None or isinstance(priority, str)):
+            raise DataError('invalid priority')
+        self.priority = priority
+
     def error_response(self, error: Any) -> 'Response':
         assert error is not None
         return Response({
@@ -122,3 +131,56 @@ class Response:
         else:
             data['result'] = self.result
         return data
+
+class BatchRequest:
+    '''
+    A JSON-RPC 2.0 batch, an array of request objects sent at once
+    '''
+    def __init__(self, reqs: List[Request]) -> None:
+        self.reqs = reqs
+
+    def __len__(self) -> int:
+        return len(self.reqs)
+
+    def as_json(self) -> List[Dict[str, Any]]:
+        return [req.as_json() for req in self.reqs]
+
+    def match_responses(self, body: Any) -> List[Dict[str, Any]]:
+        '''
+        Order the response array by the requests, entries the peer
+        did not answer get an error response
+        '''
+        if not isinstance(body, list):
+            raise DataError('batch response is not an array')
+        resp_map = {}
+        for resp in body:
+            if isinstance(resp, dict) and resp.get('id') is not None:
+                resp_map[resp['id']] = resp
+        results = []
+        for req in self.reqs:
+            resp = resp_map.get(req.req_id)
+            if resp is None:
+                resp = req.error_response({
+                    'code': 'no response',
+                    'message': 'no response in batch for {}'.format(
+                        req.req_id)}).as_json()
+            results.append(resp)
+        return results
+
+    def error_responses(self, e: Exception) -> List[Dict[str, Any]]:
+        '''
+        One error response per request for a batch that failed as a
+        whole, e.g. its service is not found or it timed out
+        '''
+        if isinstance(e, ServiceError):
+            code = e.code
+        elif isinstance(e, NoServiceFound):
+            code = 'no service found'
+        elif isinstance(e, asyncio.TimeoutError):
+            code = 'timeout'
+        else:
+            code = 'batch failed'
+        return [req.error_response({
+            'code': code,
+            'message': str(e) or code}).as_json()
+                for req in self.reqs]
@@ -0,0 +1,43 @@
+from typing import Optional
+from contextvars import ContextVar, Token
+
+# request priority classes, lower ranks are served first
+PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+DEFAULT_PRIORITY = 'normal'
+
+# a queued call of a class one rank lower is served before a newer
+# call of the higher class once it has waited this much longer, so
+# low priority work is delayed but never starved
+PRIORITY_AGING_SECS = 1.0
+
+# the priority of the request being served, nested pool calls made
+# while serving it inherit it
+_priority: ContextVar[Optional[str]] = ContextVar(
+    'bbox_priority', default=None)
+
+def normalize(priority: Optional[str]) -> str:
+    if priority in PRIORITIES:
+        return priority
+    return DEFAULT_PRIORITY
+
+def rank(priority: Optional[str]) -> int:
+    return PRIORITIES[normalize(priority)]
+
+def get_priority() -> Optional[str]:
+    return _priority.get()
+
+def inherited() -> Optional[str]:
+    '''
+    The priority nested calls take from the request being served,
+    None for the default so that it is not sent
+    '''
+    priority = _priority.get()
+    if priority == DEFAULT_PRIORITY:
+        return None
+    return priority
+
+def set_priority(priority: Optional[str]) -> Token:
+    return _priority.set(priority)
+
+def reset_priority(token: Token) -> None:
+    _priority.reset(token)
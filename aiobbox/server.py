@@ -1,12 +1,15 @@
-from typing import Dict, Any, List, Union, Iterable, Callable, Optional
+from typing import Dict, Any, List, Union, Iterable, Callable, Optional, Set, Tuple
 import re
 import time
 import logging
 import os, json
+import tempfile
+import inspect
 import asyncio
 import json
-from aiohttp import web
-from functools import wraps
+from aiohttp import web, WSMsgType
+from aiohttp.web import ContentCoding
+from functools import wraps, partial
 from aiobbox import testing
 from aiobbox.jsonrpc import Request
 from aiobbox.cluster import get_box, get_cluster
@@ -14,8 +17,23 @@ from aiobbox.exceptions import ServiceError, DataError
 from aiobbox.utils import get_ssl_context, localbox_ip
 from aiobbox.metrics import collect_metrics
 from aiobbox import stats
+from aiobbox import deadline as bbox_deadline
+from aiobbox import priority as bbox_priority
+from aiobbox import codecs
+from aiobbox import compress
+from aiobbox.admission import Admission
+from aiobbox.executors import EXECUTOR_KINDS, get_executor, add_process_module
+from aiobbox.batching import Batcher, BatchFn, DEFAULT_BATCH_WINDOW, DEFAULT_BATCH_SIZE
 
 DEBUG = True
+
+# JSON results with more top level items than this are encoded and
+# written a slice at a time instead of as one body, negative disables
+STREAM_ENCODE_MIN_ITEMS = int(os.getenv('BBOX_STREAM_ENCODE_MIN_ITEMS', '5000'))
+STREAM_ENCODE_SLICE_ITEMS = 500
+# largest websocket frame either end accepts, 0 is unlimited, an
+# oversize frame tears down the socket and every call on it
+WS_MAX_MSG_SIZE = int(os.getenv('BBOX_WS_MAX_MSG_SIZE', '0'))
 logger = logging.getLogger('bbox')
 
 Method = Callable[..., Any]
@@ -30,12 +48,52 @@ def srv_names(self) -> List[str]:
 
 
 class MethodRef:
-    def __init__(self, fn:Method, **kw:Any) -> None:
+    def __init__(self, fn:Method, cache_ttl: float=0, max_concurrency: int=0, max_queue: int=0, executor: Optional[str]=None, coalesce: bool=False, **kw:Any) -> None:
         self.fn = fn
+        # seconds the callers may cache a successful result
+        self.cache_ttl = cache_ttl
+        # calls running at once, 0 is unlimited, and calls waiting
+        # for a slot before new ones are rejected as overloaded
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        # async generator methods stream their items to the caller
+        self.streaming = inspect.isasyncgenfunction(fn)
+        # synchronous methods run in the thread or process pool
+        self.executor = executor
+        # identical concurrent calls share one execution
+        self.coalesce = coalesce and not self.streaming
+        # calls grouped for the batch implementation, if any
+        self.batch_fn: Optional[BatchFn] = None
+        self.batch_window = DEFAULT_BATCH_WINDOW
+        self.batch_size = DEFAULT_BATCH_SIZE
+        self.batcher: Optional[Batcher] = None
 
     def get_doc(self) -> str:
         return self.fn.__doc__ or ''
 
+    def get_batcher(self, stats_name: str) -> Batcher:
+        assert self.batch_fn is not None
+        if self.batcher is None:
+            self.batcher = Batcher(stats_name, self.batch_fn,
+                                   window=self.batch_window,
+                                   max_size=self.batch_size)
+        return self.batcher
+
+    def get_limits(self, full_method: str) -> Tuple[int, int]:
+        return admission_limits(full_method,
+                                self.max_concurrency, self.max_queue)
+
+def admission_limits(name: str, max_concurrency: int=0, max_queue: int=0) -> Tuple[int, int]:
+    '''
+    max_concurrency and max_queue, the admission box config maps full
+    method names, or "*" for the whole box, to overrides, e.g.
+    {"srv::method": {"max_concurrency": 8, "max_queue": 100}}
+    '''
+    limits = get_box().get_box_config('admission', default={})
+    override = limits.get(name) or {}
+    return (override.get('max_concurrency', max_concurrency),
+            override.get('max_queue', max_queue))
+
 class Service(object):
     def __init__(self) -> None:
         self.methods: Dict[str, MethodRef] = {}
@@ -47,26 +105,79 @@ class Service(object):
             logger.warn('srv {} already exist'.format(srv_name))
         srv_dict[srv_name] = self
 
-    def method(self, name: str, for_test: bool=False) -> Method:
+    def method(self, name: str, for_test: bool=False, cache_ttl: float=0, max_concurrency: int=0, max_queue: int=0, executor: Optional[str]=None, coalesce: bool=False) -> Method:
         def decorator(fn: Method) -> Method:
             if for_test and not testing.test_mode():
                 # this method cannot be added
                 # for non testing env
                 return fn
+            if executor is not None:
+                if executor not in EXECUTOR_KINDS:
+                    raise ValueError(
+                        'unknown executor {}'.format(executor))
+                if (inspect.iscoroutinefunction(fn) or
+                    inspect.isasyncgenfunction(fn)):
+                    raise TypeError(
+                        'method {} run by an executor must be a plain function'.format(name))
+                if executor == 'process':
+                    add_process_module(fn.__module__)
             __w = wraps(fn)(fn)
-            if name in self.methods:
+            old_ref = self.methods.get(name)
+            if old_ref is not None and old_ref.fn is not old_ref.batch_fn:
                 logger.warn('method {} already exist'.format(name))
-            self.methods[name] = MethodRef(__w)
+            method_ref = MethodRef(
+                __w, cache_ttl=cache_ttl,
+                max_concurrency=max_concurrency,
+                max_queue=max_queue,
+                executor=executor,
+                coalesce=coalesce)
+            if old_ref is not None and old_ref.batch_fn is not None:
+                # the batch implementation was registered first
+                method_ref.batch_fn = old_ref.batch_fn
+                method_ref.batch_window = old_ref.batch_window
+                method_ref.batch_size = old_ref.batch_size
+            self.methods[name] = method_ref
             return __w
         return decorator
 
+    def batch(self, name: str, window: float=DEFAULT_BATCH_WINDOW, max_size: int=DEFAULT_BATCH_SIZE) -> BatchFn:
+        '''
+        Register fn(params_list) -> results as the batch implementation
+        of method name, calls of the method arriving within window
+        seconds are dispatched to it together.  The method is added if
+        it has no per call implementation
+        '''
+        def decorator(fn: BatchFn) -> BatchFn:
+            if inspect.isasyncgenfunction(fn):
+                raise TypeError(
+                    'batch implementation of {} cannot stream'.format(name))
+            method_ref = self.methods.get(name)
+            if method_ref is None:
+                method_ref = MethodRef(fn)
+                self.methods[name] = method_ref
+            elif method_ref.streaming:
+                raise TypeError(
+                    'streaming method {} cannot be batched'.format(name))
+            method_ref.batch_fn = fn
+            method_ref.batch_window = window
+            method_ref.batch_size = max_size
+            return fn
+        return decorator
+
     def get_docs(self, srv_name: str) -> Dict[str, Any]:
         arr = []
         for name, mref in sorted(self.methods.items()):
             doc = mref.get_doc()
             arr.append({
                 'doc': doc,
-                'name': name
+                'name': name,
+                'cache_ttl': mref.cache_ttl,
+                'streaming': mref.streaming,
+                'max_concurrency': mref.max_concurrency,
+                'max_queue': mref.max_queue,
+                'executor': mref.executor,
+                'batch': mref.batch_fn is not None,
+                'coalesce': mref.coalesce
                 })
         return {
             'name': srv_name,
@@ -74,17 +185,91 @@ class Service(object):
             'methods': arr
         }
 
+class StreamResult:
+    '''
+    The items of a streaming method, the first one is produced up
+    front so that early failures are still plain error responses.
+    The admission slots of the call are held until the stream ends
+    or is closed, and every item runs under the priority of the call
+    and a deadline as long as the one of the first item
+    '''
+    def __init__(self, sreq: 'ServiceRequest', agen: Any, first: Any) -> None:
+        self.sreq = sreq
+        self.agen = agen
+        self.head = [first]
+        self.item_timeout: Optional[float] = None
+        self.releases: List[Callable[[], None]] = []
+
+    def __aiter__(self) -> 'StreamResult':
+        return self
+
+    async def __anext__(self) -> Any:
+        if self.head:
+            return self.head.pop()
+        deadline = None
+        if self.item_timeout is not None:
+            deadline = time.time() + self.item_timeout
+        token = bbox_deadline.set_deadline(deadline)
+        priority_token = bbox_priority.set_priority(self.sreq.priority)
+        try:
+            return await self.agen.__anext__()
+        except BaseException:
+            self.release()
+            raise
+        finally:
+            bbox_deadline.reset_deadline(token)
+            bbox_priority.reset_priority(priority_token)
+
+    def release(self) -> None:
+        releases, self.releases = self.releases, []
+        for release in reversed(releases):
+            release()
+
+    async def aclose(self) -> None:
+        try:
+            await self.agen.aclose()
+        finally:
+            self.release()
+
+# running calls of coalesced methods by their method and params
+_coalesced: Dict[Tuple[str, str], asyncio.Future] = {}
+
+# admission per '/srv/method' and '*' for the whole box
+_admissions: Dict[str, Admission] = {}
+
+def get_admission(stats_name: str) -> Admission:
+    admission = _admissions.get(stats_name)
+    if admission is None:
+        admission = Admission(stats_name)
+        _admissions[stats_name] = admission
+    return admission
+
 class ServiceRequest:
     srv: Optional['Service'] = None
     req: Request
 
     @classmethod
-    def from_body(cls, body:Dict[str, Any]) -> 'ServiceRequest':
+    def from_body(cls, body:Dict[str, Any], deadline: Optional[float]=None, stream: bool=False, priority: Optional[str]=None) -> 'ServiceRequest':
         req = Request(body)
-        return cls(req)
+        return cls(req, deadline=deadline, stream=stream,
+                   priority=priority)
 
-    def __init__(self, req):
+    def __init__(self, req, deadline: Optional[float]=None, stream: bool=False, priority: Optional[str]=None):
         self.req = req
+        # the priority field of the request wins over the one given
+        # for the whole HTTP request
+        self.priority = bbox_priority.normalize(req.priority or priority)
+        # absolute time the caller stops waiting for the response
+        self.deadline = deadline
+        # the caller can take the items of a streaming method one by
+        # one, otherwise they are collected into a list
+        self.stream = stream
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # sent to the process pool without the service and its methods
+        state = dict(self.__dict__)
+        state.pop('srv', None)
+        return state
 
     async def handle(self) -> Dict[str, Any]:
         stats_name = None
@@ -111,8 +296,22 @@ class ServiceRequest:
                         'method not found',
                         'Method {} does not exist'.format(
                             self.req.method))
-                resp = await self.call_method(method_ref, self.req.srv_name)
-        except DataError as e:
+                if method_ref.coalesce:
+                    resp = await self.call_coalesced(
+                        method_ref, self.req.srv_name)
+                else:
+                    resp = await self.call_method(
+                        method_ref, self.req.srv_name)
+        except Exception as e:
+            resp = self.error_response(e, stats_name)
+        return resp
+
+    def error_response(self, e: Exception, stats_name: Optional[str]=None) -> Dict[str, Any]:
+        '''
+        The JSON-RPC error response of an exception raised while
+        handling the request
+        '''
+        if isinstance(e, DataError):
             error_info = {
                 'message': str(e),
                 'code': 'request parse error'
@@ -126,11 +325,14 @@ class ServiceRequest:
                 'error': error_info,
                 'id': self.req.body.get('id')
             }
-        except ServiceError as e:
+        elif isinstance(e, ServiceError):
             error_info = {
                 'message': getattr(e, 'message', str(e)),
                 'code': e.code
             }
+            retry_after = getattr(e, 'retry_after', None)
+            if retry_after is not None:
+                error_info['retry_after'] = retry_after
             logger.warn(
                 'service error on JSON-RPC id %s',
                 self.req.req_id,
@@ -139,7 +341,7 @@ class ServiceRequest:
                 'jsonrpc': '2.0',
                 'error': error_info,
                 'id': self.req.req_id}
-        except Exception as e:
+        else:
             import traceback
             traceback.print_exc()
             logger.error('error on JSON-RPC id %s',
@@ -169,11 +371,48 @@ class ServiceRequest:
         start_time = time.time()
         stats_name = '/{}/{}'.format(
             srv_name, self.req.method)
-        stats.rpc_request_count.incr(stats_name)
-        res: Any = await method_ref.fn(self, *self.req.params)
+        token = bbox_deadline.set_deadline(self.deadline)
+        priority_token = bbox_priority.set_priority(self.priority)
+        # release the admission slots taken, in reverse order
+        releases: List[Callable[[], None]] = []
+        try:
+            left = bbox_deadline.remaining()
+            if left is not None and left <= 0:
+                stats.expired_rpc_request_count.incr(stats_name)
+                raise ServiceError(
+                    'deadline exceeded',
+                    'request {} expired before execution'.format(
+                        self.req.req_id))
+            method_limits = method_ref.get_limits(self.req.full_method)
+            method_admission = get_admission(stats_name)
+            await self.admit(method_admission, method_limits)
+            releases.append(
+                partial(method_admission.release, method_limits[0]))
+            # then a slot of the box shared by all methods
+            box_limits = admission_limits('*')
+            box_admission = get_admission('*')
+            await self.admit(box_admission, box_limits)
+            releases.append(
+                partial(box_admission.release, box_limits[0]))
+            stats.rpc_request_count.incr(stats_name)
+            res = await self.run_method(
+                method_ref, bbox_deadline.remaining())
+            if isinstance(res, StreamResult):
+                # the stream keeps running after the call returns
+                res.releases, releases = releases, []
+                if self.deadline is not None:
+                    res.item_timeout = self.deadline - start_time
+        finally:
+            for release in reversed(releases):
+                release()
+            bbox_deadline.reset_deadline(token)
+            bbox_priority.reset_priority(priority_token)
         resp: Dict[str, Any] = {'result': res,
                                 'id': self.req.req_id,
                                 'jsonrpc': '2.0'}
+        if method_ref.cache_ttl > 0:
+            # hint for the client side response cache
+            resp['cache_ttl'] = method_ref.cache_ttl
         end_time = time.time()
         if end_time - start_time > 1.0:
             logging.warn(
@@ -185,11 +424,355 @@ class ServiceRequest:
             stats.slow_rpc_request_count.incr(stats_name)
         return resp
 
+    async def call_coalesced(self, method_ref: MethodRef, srv_name: str) -> Dict[str, Any]:
+        '''
+        Join the running call of the same method and params if there
+        is one, otherwise run it and share its response or error with
+        the calls joining meanwhile.  The call runs under the deadline
+        of the caller running it, the others run it again when that
+        deadline is exceeded or that caller goes away
+        '''
+        try:
+            key = (self.req.full_method,
+                   json.dumps(self.req.params, sort_keys=True))
+        except (TypeError, ValueError):
+            return await self.call_method(method_ref, srv_name)
+
+        fut = _coalesced.get(key)
+        if fut is not None:
+            stats.coalesced_rpc_request_count.incr(
+                '/{}/{}'.format(srv_name, self.req.method))
+            timeout = None
+            if self.deadline is not None:
+                timeout = self.deadline - time.time()
+            try:
+                resp = await asyncio.wait_for(asyncio.shield(fut), timeout)
+            except asyncio.TimeoutError:
+                raise ServiceError(
+                    'deadline exceeded',
+                    'request {} exceeded the deadline of caller'.format(
+                        self.req.req_id))
+            except asyncio.CancelledError:
+                if not fut.cancelled():
+                    raise
+                # the caller running it went away, run it again
+                return await self.call_coalesced(method_ref, srv_name)
+            except ServiceError as e:
+                if e.code != 'deadline exceeded':
+                    raise
+                # the deadline of the caller running it, not ours
+                return await self.call_coalesced(method_ref, srv_name)
+            return dict(resp, id=self.req.req_id)
+
+        fut = asyncio.get_event_loop().create_future()
+        # nobody may have joined to take the error
+        fut.add_done_callback(
+            lambda f: f.cancelled() or f.exception())
+        _coalesced[key] = fut
+        try:
+            resp = await self.call_method(method_ref, srv_name)
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            raise
+        else:
+            fut.set_result(resp)
+        finally:
+            if _coalesced.get(key) is fut:
+                del _coalesced[key]
+        return resp
+
+    async def admit(self, admission: Admission, limits: Tuple[int, int]) -> None:
+        max_concurrency, max_queue = limits
+        acquire = admission.acquire(max_concurrency, max_queue,
+                                    priority=self.priority)
+        timeout = bbox_deadline.remaining()
+        if timeout is None:
+            await acquire
+            return
+        try:
+            await asyncio.wait_for(acquire, timeout)
+        except asyncio.TimeoutError:
+            stats.expired_rpc_request_count.incr(admission.stats_name)
+            raise ServiceError(
+                'deadline exceeded',
+                'request {} expired waiting for admission'.format(
+                    self.req.req_id))
+
+    async def run_method(self, method_ref: MethodRef, timeout: Optional[float]) -> Any:
+        if method_ref.batch_fn is not None:
+            cor = method_ref.get_batcher(
+                '/{}/{}'.format(self.req.srv_name, self.req.method)).submit(
+                    self.req.params)
+        elif method_ref.executor:
+            cor = get_executor(method_ref.executor).run(
+                method_ref.fn, self, *self.req.params)
+        else:
+            cor = method_ref.fn(self, *self.req.params)
+        if method_ref.streaming:
+            cor = self.open_stream(cor)
+        if timeout is None:
+            return await cor
+        try:
+            return await asyncio.wait_for(cor, timeout)
+        except asyncio.TimeoutError:
+            left = bbox_deadline.remaining()
+            if left is not None and left <= 0:
+                raise ServiceError(
+                    'deadline exceeded',
+                    'request {} exceeded the deadline of caller'.format(
+                        self.req.req_id))
+            raise
+
+    async def open_stream(self, agen: Any) -> Any:
+        '''
+        A StreamResult when the caller takes a stream, otherwise the
+        list of all items
+        '''
+        if not self.stream:
+            return [item async for item in agen]
+        try:
+            first = await agen.__anext__()
+        except StopAsyncIteration:
+            return []
+        return StreamResult(self, agen, first)
+
+def get_deadline(request: web.Request) -> Optional[float]:
+    '''
+    The absolute deadline of a request from X-Bbox-Expect-Timeout
+    '''
+    try:
+        timeout = float(request.headers['X-Bbox-Expect-Timeout'])
+    except (KeyError, ValueError):
+        return None
+    return time.time() + timeout
+
+async def handle_body(body: Any, deadline: Optional[float]=None, stream: bool=False, priority: Optional[str]=None) -> Dict[str, Any]:
+    try:
+        sreq = ServiceRequest.from_body(body, deadline=deadline,
+                                        stream=stream, priority=priority)
+    except (DataError, KeyError, TypeError, AttributeError) as e:
+        logger.warn('json rpc error on parsing %s', body)
+        req_id = body.get('id') if isinstance(body, dict) else None
+        return {
+            'jsonrpc': '2.0',
+            'error': {
+                'message': str(e),
+                'code': 'request parse error'
+            },
+            'id': req_id
+        }
+    return await sreq.handle()
+
+async def handle_batch(bodies: List[Any], deadline: Optional[float]=None, priority: Optional[str]=None) -> List[Dict[str, Any]]:
+    '''
+    Run the entries of a JSON-RPC batch concurrently, notifications
+    get no response entry
+    '''
+    resps = await asyncio.gather(
+        *[handle_body(body, deadline=deadline, priority=priority)
+          for body in bodies])
+    return [resp for body, resp in zip(bodies, resps)
+            if not (isinstance(body, dict) and body.get('id') is None)]
+
+def encode_response(request: web.Request, resp: Any, codec: codecs.Codec) -> web.Response:
+    try:
+        body = codec.encode(resp)
+    except (TypeError, ValueError, OverflowError):
+        if codec is codecs.json_codec:
+            raise
+        logger.warn('cannot encode response by %s, use json instead',
+                    codec.name, exc_info=True)
+        codec = codecs.json_codec
+        body = codec.encode(resp)
+    return compress.make_response(request, body, codec.content_type)
+
 async def handle(request):
-    body = await request.json()
-    sreq = ServiceRequest.from_body(body)
-    resp = await sreq.handle()
-    return web.json_response(resp)
+    deadline = get_deadline(request)
+    req_codec = codecs.get_codec(request.content_type)
+    body = req_codec.decode(await request.read())
+    codec = codecs.negotiate(request.headers.get('Accept'),
+                             default=req_codec)
+    priority = request.headers.get('X-Bbox-Priority')
+    if isinstance(body, list):
+        if not body:
+            return encode_response(request, {
+                'jsonrpc': '2.0',
+                'error': {
+                    'message': 'empty batch',
+                    'code': 'request parse error'
+                },
+                'id': None}, codec)
+        resps = await handle_batch(body, deadline=deadline,
+                                   priority=priority)
+        return encode_response(request, resps, codec)
+    stream = codecs.NDJSON_CONTENT_TYPE in request.headers.get('Accept', '')
+    resp = await handle_body(body, deadline=deadline, stream=stream,
+                             priority=priority)
+    result = resp.get('result')
+    if isinstance(result, StreamResult):
+        return await stream_response(request, resp)
+    if (codec is codecs.json_codec and
+        STREAM_ENCODE_MIN_ITEMS >= 0 and
+        isinstance(result, (list, dict)) and
+        len(result) > STREAM_ENCODE_MIN_ITEMS):
+        return await write_large_response(request, resp)
+    return encode_response(request, resp, codec)
+
+def encode_slices(result: Union[List[Any], Dict[Any, Any]]) -> Iterable[bytes]:
+    '''
+    The JSON encoding of a list or dict in pieces of at most
+    STREAM_ENCODE_SLICE_ITEMS items
+    '''
+    encode = codecs.json_codec.encode
+    if isinstance(result, dict):
+        items: List[Any] = list(result.items())
+        yield b'{'
+    else:
+        items = result
+        yield b'['
+    for start in range(0, len(items), STREAM_ENCODE_SLICE_ITEMS):
+        part = items[start:start + STREAM_ENCODE_SLICE_ITEMS]
+        data = encode(dict(part) if isinstance(result, dict) else part)
+        # strip the brackets of the slice
+        if start > 0:
+            yield b',' + data[1:-1]
+        else:
+            yield data[1:-1]
+    yield b'}' if isinstance(result, dict) else b']'
+
+async def write_large_response(request: web.Request, resp: Dict[str, Any]) -> web.StreamResponse:
+    '''
+    Write a JSON response whose result has many items slice by slice,
+    so the encoded body never exists as a whole
+    '''
+    head = dict(resp)
+    result = head.pop('result')
+    response = web.StreamResponse(
+        headers={'Content-Type': codecs.JSON_CONTENT_TYPE,
+                 compress.ACCEPT_HEADER: compress.ACCEPT_VALUE,
+                 'Vary': 'Accept-Encoding'})
+    encoding = compress.choose_encoding(
+        request.headers.get('Accept-Encoding'))
+    if encoding and compress.COMPRESS_MIN_SIZE >= 0:
+        response.enable_compression(ContentCoding(encoding))
+    await response.prepare(request)
+    try:
+        # the envelope without its closing brace
+        await response.write(
+            codecs.json_codec.encode(head)[:-1] + b',"result":')
+        for data in encode_slices(result):
+            await response.write(data)
+        await response.write(b'}')
+    except ConnectionError:
+        logger.info('caller of JSON-RPC id %s went away', resp.get('id'))
+        return response
+    await response.write_eof()
+    return response
+
+async def stream_response(request: web.Request, resp: Dict[str, Any]) -> web.StreamResponse:
+    '''
+    Write the items of a streaming method as NDJSON lines of
+    {"item": ...} as they are produced, the last line is the JSON-RPC
+    response whose result is the number of items.  Writes wait for
+    the socket to drain so the method runs no faster than the caller
+    reads
+    '''
+    result: StreamResult = resp['result']
+    sreq = result.sreq
+    response = web.StreamResponse(
+        headers={'Content-Type': codecs.NDJSON_CONTENT_TYPE})
+    await response.prepare(request)
+    count = 0
+    try:
+        while True:
+            try:
+                line = codecs.json_codec.encode(
+                    {'item': await result.__anext__()})
+            except StopAsyncIteration:
+                resp['result'] = count
+                break
+            except Exception as e:
+                resp = sreq.error_response(
+                    e, '/{}/{}'.format(sreq.req.srv_name, sreq.req.method))
+                break
+            try:
+                await response.write(line + b'\n')
+            except ConnectionError:
+                logger.info('caller of %s went away after %s items',
+                            sreq.req.full_method, count)
+                return response
+            count += 1
+    finally:
+        await result.aclose()
+    await response.write(codecs.json_codec.encode(resp) + b'\n')
+    await response.write_eof()
+    return response
+
+def body_deadline(body: Any) -> Optional[float]:
+    '''
+    The deadline of a websocket frame from the timeout its entries
+    carry, websocket frames have no headers
+    '''
+    entries = body if isinstance(body, list) else [body]
+    timeouts = [entry['timeout'] for entry in entries
+                if isinstance(entry, dict) and
+                isinstance(entry.get('timeout'), (int, float))]
+    if not timeouts:
+        return None
+    return time.time() + min(timeouts)
+
+async def handle_ws(request):
+    '''
+    JSON-RPC over a websocket, every text frame is a request or a
+    batch, answered asynchronously in whatever order they complete
+    '''
+    ws = web.WebSocketResponse(max_msg_size=WS_MAX_MSG_SIZE)
+    await ws.prepare(request)
+    send_lock = asyncio.Lock()
+    tasks: Set[asyncio.Future] = set()
+
+    async def respond(body: Any, codec: codecs.Codec) -> None:
+        deadline = body_deadline(body)
+        if isinstance(body, list):
+            resp: Any = await handle_batch(body, deadline=deadline)
+        else:
+            resp = await handle_body(body, deadline=deadline)
+            if isinstance(body, dict) and body.get('id') is None:
+                # notification
+                return
+        if ws.closed:
+            return
+        async with send_lock:
+            if codec.binary:
+                await ws.send_bytes(codec.encode(resp))
+            else:
+                await ws.send_str(codec.encode(resp).decode('utf-8'))
+
+    try:
+        async for msg in ws:
+            if msg.type in (WSMsgType.TEXT, WSMsgType.BINARY):
+                # binary frames carry the compact encoding
+                if msg.type == WSMsgType.BINARY:
+                    codec = codecs.get_codec(codecs.MSGPACK_CONTENT_TYPE)
+                else:
+                    codec = codecs.json_codec
+                try:
+                    body = codec.decode(msg.data)
+                except Exception:
+                    logger.warn('invalid frame on websocket %s', msg.data)
+                    continue
+                task = asyncio.ensure_future(respond(body, codec))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            elif msg.type == WSMsgType.ERROR:
+                logger.warn('websocket error %s', ws.exception())
+    finally:
+        for task in list(tasks):
+            task.cancel()
+    return ws
 
 async def index(request):
     return web.Response(text='hello')
@@ -199,7 +782,9 @@ async def handle_metrics_json(request):
     box = get_box()
     for name, labels, v in resp['lines']:
         labels['box'] = box.boxid
-    return web.json_response(resp)
+    return compress.make_response(
+        request, codecs.json_codec.encode(resp),
+        codecs.JSON_CONTENT_TYPE)
 
 async def handle_metrics(request):
     '''
@@ -218,34 +803,60 @@ async def handle_metrics(request):
                       for lname, lvalue in labels.items())
         d = '{' + d + '}'
         lines.append('{} {} {}'.format(name, d, v))
-    return web.Response(text='\n'.join(lines))
+    return compress.make_response(
+        request, '\n'.join(lines).encode('utf-8'), 'text/plain',
+        charset='utf-8')
 
-async def start_server(args, **box_args):
+async def register_box(args, **box_args) -> Any:
+    '''
+    Register the box of the loaded services in the cluster
+    '''
     boxid = args.boxid
 
-    ssl_context = get_ssl_context(args.ssl)
-
     # server etcd agent
     srv_names = list(srv_dict.keys())
     curr_box = get_box()
     curr_box.ssl_prefix = args.ssl
+    unix_dir = getattr(args, 'unix_dir', tempfile.gettempdir())
+    if unix_dir and not args.ssl:
+        # same host callers skip TCP through this socket
+        curr_box.unix_path = os.path.join(
+            unix_dir, 'bbox-{}.sock'.format(boxid))
     await curr_box.start(boxid, srv_names, **box_args)
+    logger.warn('box {} launched as {}'.format(
+        curr_box.boxid,
+        curr_box.bind))
+    return curr_box
+
+def make_app() -> web.Application:
     app = web.Application()
     app.router.add_post('/jsonrpc/2.0/api', handle)
-    #app.router.add_route('*', '/jsonrpc/2.0/ws', handle_ws)
+    app.router.add_get('/jsonrpc/2.0/ws', handle_ws)
     app.router.add_get('/metrics', handle_metrics)
     app.router.add_get('/metrics.json', handle_metrics_json)
     app.router.add_get('/', index)
+    return app
 
+def get_listen_addr() -> Tuple[str, int]:
+    curr_box = get_box()
     host, port = curr_box.bind.split(':')
     if not localbox_ip(host):
         host = '0.0.0.0'
-    logger.warn('box {} launched as {}'.format(
-        curr_box.boxid,
-        curr_box.bind))
-    handler = app.make_handler()
+    return host, int(port)
+
+async def start_server(args, **box_args):
+    ssl_context = get_ssl_context(args.ssl)
+    curr_box = await register_box(args, **box_args)
+    handler = make_app().make_handler()
+    host, port = get_listen_addr()
     loop = asyncio.get_event_loop()
     srv = await loop.create_server(handler,
                                    host, port,
                                    ssl=ssl_context)
+    if curr_box.unix_path:
+        if os.path.exists(curr_box.unix_path):
+            os.unlink(curr_box.unix_path)
+        await loop.create_unix_server(handler, curr_box.unix_path)
+        logger.info('box %s also listens on %s',
+                    curr_box.boxid, curr_box.unix_path)
     return srv, handler
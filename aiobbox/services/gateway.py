@@ -7,6 +7,7 @@ from aiobbox.server import Service, ServiceError
 from aiobbox.client import pool as srv_pool
 from aiobbox.exceptions import ConnectionError, NoServiceFound
 from aiobbox.handler import BaseHandler
+from aiobbox.contrib.consumer.ratelimit import check_request
 
 # service
 srv = Service()
@@ -20,6 +21,9 @@ default_backend = None
 async def handle_req(request):
     if not default_backend:
         return web.HTTPNotFound()
+    limited = await check_request(request)
+    if limited is not None:
+        return limited
     webreq = {
         'method': request.method,
         'path': request.path,
@@ -14,6 +14,7 @@ from aiobbox.jsonrpc import Request, DataError
 from aiobbox.client import pool as srv_pool
 from aiobbox.exceptions import ConnectionError, NoServiceFound
 from aiobbox.handler import BaseHandler
+from aiobbox.contrib.consumer.ratelimit import check_request
 
 logger = logging.getLogger('bbox')
 
@@ -34,6 +35,10 @@ async def handle_rpc(request: web.Request) -> web.Response: # type: ignore
             logger.warn('method not allowed')
             return web.HTTPForbidden()
 
+    limited = await check_request(request)
+    if limited is not None:
+        return limited
+
     try:
         timeout = float(
             request.headers.get('X-Bbox-Proxy-Timeout', '20'))
@@ -3,8 +3,9 @@ from collections import defaultdict
 from aiobbox.metrics import add_metrics, IMetricsEntry, MEntry
 
 class RPCRequestCount(IMetricsEntry):
-    def __init__(self, name:str, help:str=''):
+    def __init__(self, name:str, help:str='', label:str='endpoint'):
         self.name = name
+        self.label = label
         if not help:
             self.help = self.name.replace('_', ' ')
         else:
@@ -18,7 +19,7 @@ class RPCRequestCount(IMetricsEntry):
         self.values[endpoint] = v
 
     async def collect(self) -> List[MEntry]:
-        arr:List[MEntry] = [({'endpoint': k}, v)
+        arr:List[MEntry] = [({self.label: k}, v)
                for k, v in self.values.items()]
         # clear old value
         self.values = defaultdict(int)
@@ -38,3 +39,105 @@ error_rpc_request_count = RPCRequestCount(
     'error_rpc_requests',
     help='Error RPC request count since last time')
 add_metrics(error_rpc_request_count)
+
+expired_rpc_request_count = RPCRequestCount(
+    'expired_rpc_requests',
+    help='RPC requests expired before execution since last time')
+add_metrics(expired_rpc_request_count)
+
+client_cache_hit_count = RPCRequestCount(
+    'rpc_client_cache_hits',
+    help='RPC client cache hit count since last time')
+add_metrics(client_cache_hit_count)
+
+client_cache_miss_count = RPCRequestCount(
+    'rpc_client_cache_misses',
+    help='RPC client cache miss count since last time')
+add_metrics(client_cache_miss_count)
+
+client_breaker_trip_count = RPCRequestCount(
+    'rpc_client_breaker_trips',
+    help='RPC client circuit breaker trips since last time')
+add_metrics(client_breaker_trip_count)
+
+client_hedge_count = RPCRequestCount(
+    'rpc_client_hedges',
+    help='RPC client hedged request count since last time')
+add_metrics(client_hedge_count)
+
+client_hedge_win_count = RPCRequestCount(
+    'rpc_client_hedge_wins',
+    help='RPC client hedged requests answered first since last time')
+add_metrics(client_hedge_win_count)
+
+compress_saved_bytes = RPCRequestCount(
+    'compress_saved_bytes',
+    help='Bytes saved by compressing bodies since last time')
+add_metrics(compress_saved_bytes)
+
+compress_seconds = RPCRequestCount(
+    'compress_seconds',
+    help='Seconds spent compressing bodies since last time')
+add_metrics(compress_seconds)
+
+class RPCGauge(RPCRequestCount):
+    '''
+    Current value per endpoint, kept across collections
+    '''
+    async def collect(self) -> List[MEntry]:
+        return [({self.label: k}, v)
+                for k, v in self.values.items()]
+
+inflight_rpc_request_gauge = RPCGauge(
+    'inflight_rpc_requests',
+    help='RPC requests running now')
+add_metrics(inflight_rpc_request_gauge)
+
+queued_rpc_request_gauge = RPCGauge(
+    'queued_rpc_requests',
+    help='RPC requests waiting for admission now')
+add_metrics(queued_rpc_request_gauge)
+
+overloaded_rpc_request_count = RPCRequestCount(
+    'overloaded_rpc_requests',
+    help='RPC requests rejected as overloaded since last time')
+add_metrics(overloaded_rpc_request_count)
+
+queued_priority_gauge = RPCGauge(
+    'queued_rpc_requests_by_priority',
+    help='RPC requests waiting for admission now by priority',
+    label='priority')
+add_metrics(queued_priority_gauge)
+
+priority_wait_seconds = RPCRequestCount(
+    'rpc_priority_wait_seconds',
+    help='Seconds RPC requests waited for admission by priority since last time',
+    label='priority')
+add_metrics(priority_wait_seconds)
+
+executor_queued_gauge = RPCGauge(
+    'executor_queued_calls',
+    help='Method calls waiting for a worker of the executor now',
+    label='executor')
+add_metrics(executor_queued_gauge)
+
+executor_utilization_gauge = RPCGauge(
+    'executor_utilization',
+    help='Share of the executor workers busy now',
+    label='executor')
+add_metrics(executor_utilization_gauge)
+
+batch_count = RPCRequestCount(
+    'rpc_batches',
+    help='Batches dispatched to batch implementations since last time')
+add_metrics(batch_count)
+
+batch_call_count = RPCRequestCount(
+    'rpc_batched_calls',
+    help='RPC requests dispatched in batches since last time')
+add_metrics(batch_call_count)
+
+coalesced_rpc_request_count = RPCRequestCount(
+    'coalesced_rpc_requests',
+    help='RPC requests answered by an identical running call since last time')
+add_metrics(coalesced_rpc_request_count)
@@ -78,6 +78,7 @@ class Handler(BaseHandler):
 
         extbind = os.getenv('BBOX_EXTBIND', '')
         bind_ip = os.getenv('BBOX_BIND_IP', '127.0.0.1')
+        zone = os.getenv('BBOX_ZONE', '')
 
         config_json = {
             'name': prjname,
@@ -86,6 +87,7 @@ class Handler(BaseHandler):
             'language': lang,
             'bind_ip': bind_ip,
             'extbind': extbind,
+            'zone': zone,
             'port_range': port_range
         }
         with open(config_file, 'w', encoding='utf-8') as f:
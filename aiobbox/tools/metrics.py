@@ -16,6 +16,7 @@ from aiobbox.cluster import get_box, get_cluster
 from aiobbox.cluster import get_ticket
 from aiobbox.utils import import_module, abs_path, semanticbool
 from aiobbox.client import HttpClient
+from aiobbox import compress
 from aiobbox.metrics import collect_cluster_metrics, report_box_failure
 
 from .httpbase import Handler as HttpdHandler
@@ -86,9 +87,9 @@ async def handle_metrics(request):
             name, define['type']))
     meta_lines.append('')
 
-    headers = {'Content-Type': 'text/plain'}
-    return web.Response(text='\n'.join(meta_lines + lines + ['']),
-                        headers=headers)
+    body = '\n'.join(meta_lines + lines + [''])
+    return compress.make_response(
+        request, body.encode('utf-8'), 'text/plain', charset='utf-8')
 
 class Handler(HttpdHandler):
     def add_arguments(self, parser):
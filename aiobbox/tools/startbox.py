@@ -1,19 +1,25 @@
-from typing import Dict, Any, List, Union, Iterable, Set
+from typing import Dict, Any, List, Union, Iterable, Set, Optional
 import os, sys
 import logging
 import uuid
+import tempfile
 import json
+import socket
+import signal
 import asyncio
 from argparse import Namespace, ArgumentParser
 import aiobbox.server as bbox_server
 from aiobbox.cluster import get_box, get_cluster
 from aiobbox.cluster import get_ticket
-from aiobbox.utils import import_module
+from aiobbox.utils import import_module, get_ssl_context
 from aiobbox.handler import BaseHandler
+from aiobbox.workers import WorkerSupervisor, WorkerShutdown, listen_tcp, listen_unix, DRAIN_TIMEOUT_SECS
+from aiobbox.executors import shutdown_executors
 
 class Handler(BaseHandler):
     help: str = 'start bbox python project'
     run_forever: bool = True
+    supervisor: Optional[WorkerSupervisor] = None
 
     def add_arguments(self, parser: ArgumentParser) -> None:
         parser.add_argument(
@@ -52,12 +58,29 @@ class Handler(BaseHandler):
             default='',
             help='ssl prefix, the files certs/$prefix/$prefix.crt and certs/$prefix/$prefix.key must exist if specified')
 
+        parser.add_argument(
+            '--unix_dir',
+            type=str,
+            default=tempfile.gettempdir(),
+            help='directory of the unix socket served to same host callers, empty to disable')
+
         parser.add_argument(
             '--ttl',
             type=float,
             default=3600 * 24,  # one day
             help='time to live')
 
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='worker processes serving the box on the same port')
+
+        parser.add_argument(
+            '--pin_cpus',
+            action='store_true',
+            help='pin every worker process to one cpu')
+
     async def run(self, args: Namespace) -> None:
         if get_ticket().language != 'python3':
             print('language must be python3', file=sys.stderr)
@@ -78,6 +101,10 @@ class Handler(BaseHandler):
             else:
                 mod_handlers.append(BaseHandler())
 
+        if args.workers > 1:
+            await self.run_workers(args, mod_handlers)
+            return
+
         # start cluster client
         await get_cluster().start()
         src, handler = await bbox_server.start_server(
@@ -92,9 +119,71 @@ class Handler(BaseHandler):
 
         asyncio.ensure_future(self.wait_ttl(args.ttl))
 
+    async def run_workers(self, args: Namespace, mod_handlers: List[BaseHandler]) -> None:
+        '''
+        Register the box once here and fork workers serving it, the
+        service modules are already imported and shared by them
+        '''
+        await get_cluster().start()
+        curr_box = await bbox_server.register_box(
+            args, port=args.port,
+            bind_ip=args.bind_ip,
+            extbind=args.extbind)
+        ssl_context = get_ssl_context(args.ssl)
+        host, port = bbox_server.get_listen_addr()
+        reuse_port = hasattr(socket, 'SO_REUSEPORT')
+        # without SO_REUSEPORT all workers accept on one socket
+        socks = [listen_tcp(host, port, reuse_port=reuse_port)
+                 for _ in range(args.workers if reuse_port else 1)]
+        unix_sock = None
+        if curr_box.unix_path:
+            unix_sock = listen_unix(curr_box.unix_path)
+
+        async def worker_main(index: int) -> WorkerShutdown:
+            sock = socks[index % len(socks)]
+            for other in socks:
+                if other is not sock:
+                    other.close()
+            # the worker needs its own view of the cluster to call
+            # other boxes, the box itself is kept alive by the parent
+            await get_cluster().start()
+            handler = bbox_server.make_app().make_handler()
+            loop = asyncio.get_event_loop()
+            servers = [await loop.create_server(
+                handler, sock=sock, ssl=ssl_context)]
+            if unix_sock is not None:
+                servers.append(await loop.create_unix_server(
+                    handler, sock=unix_sock))
+            for h in mod_handlers:
+                await h.start(args)
+
+            async def shutdown() -> None:
+                # stop accepting, then let in-flight requests finish
+                for server in servers:
+                    server.close()
+                await handler.shutdown(DRAIN_TIMEOUT_SECS)
+                for h in mod_handlers:
+                    h.shutdown()
+            return shutdown
+
+        # module handlers only run in the workers
+        self.mod_handlers = []
+        self.supervisor = WorkerSupervisor(
+            args.workers, worker_main, pin_cpus=args.pin_cpus)
+        asyncio.ensure_future(self.supervisor.supervise())
+        asyncio.ensure_future(self.wait_ttl(args.ttl))
+        # SIGTERM goes through shutdown, which stops the workers
+        # instead of leaving them behind
+        main_task = asyncio.current_task()
+        if main_task is not None:
+            asyncio.get_event_loop().add_signal_handler(
+                signal.SIGTERM, main_task.cancel)
+
     async def wait_ttl(self, ttl:float) -> None:
         await asyncio.sleep(ttl)
         logging.info('box ttl expired, stoping')
+        if self.supervisor is not None:
+            await self.supervisor.stop()
         await get_box().deregister()
         logging.info('box ttl expired, stoped')
         sys.exit(0)
@@ -102,6 +191,9 @@ class Handler(BaseHandler):
     async def shutdown(self) -> None:
         for h in self.mod_handlers:
             h.shutdown()
+        if self.supervisor is not None:
+            await self.supervisor.stop()
+        shutdown_executors(wait=False)
         await get_box().deregister()
 
 def coroutine_exc_handler(loop, context):
@@ -38,13 +38,22 @@ def semanticbool(v:str) -> bool:
     else:
         raise ValueError()
 
+def json_default(obj: Any) -> str:
+    '''
+    The JSON form of datetimes, dates and decimals, shared by every
+    encoder so that they cannot drift apart
+    '''
+    if isinstance(obj, datetime):
+        return obj.replace(microsecond=0).isoformat()
+    elif isinstance(obj, (Decimal, date)):
+        return str(obj)
+    raise TypeError(
+        'Object of type {} is not JSON serializable'.format(
+            obj.__class__.__name__))
+
 class BBoxJSONEncoder(JSONEncoder):
     def default(self, obj: Any) -> str:
-        if isinstance(obj, datetime):
-            return obj.replace(microsecond=0).isoformat()
-        elif isinstance(obj, (Decimal, date)):
-            return str(obj)
-        return JSONEncoder.default(self, obj)
+        return json_default(obj)
 
 def json_pp(v: Any) -> str:
     return json_dumps(v, indent=2, sort_keys=True, cls=BBoxJSONEncoder)
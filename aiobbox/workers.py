@@ -0,0 +1,175 @@
+'''
+Multi process boxes, the parent process registers the box once and
+owns the listening sockets, forked workers serve on them
+'''
+from typing import Dict, Callable, Awaitable, Optional
+import os
+import time
+import signal
+import socket
+import logging
+import asyncio
+import threading
+
+logger = logging.getLogger('bbox')
+
+RESTART_DELAY_SECS = 1.0
+SUPERVISE_INTERVAL_SECS = 0.5
+STOP_TIMEOUT_SECS = 10.0
+# seconds a stopping worker lets in-flight requests finish, less than
+# STOP_TIMEOUT_SECS so that it is not killed meanwhile
+DRAIN_TIMEOUT_SECS = 5.0
+
+# a worker main starts serving and returns how to stop it, if any
+WorkerShutdown = Callable[[], Awaitable[None]]
+WorkerMain = Callable[[int], Awaitable[Optional[WorkerShutdown]]]
+
+def listen_tcp(host: str, port: int, reuse_port: bool=False) -> socket.socket:
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # every worker gets its own socket on the same port and the
+        # kernel balances connections between them
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(socket.SOMAXCONN)
+    sock.setblocking(False)
+    return sock
+
+def listen_unix(path: str) -> socket.socket:
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(socket.SOMAXCONN)
+    sock.setblocking(False)
+    return sock
+
+class WorkerSupervisor:
+    '''
+    Fork count workers running main(index) on an event loop of their
+    own and restart the ones that exit until stopped.  A worker runs
+    the shutdown returned by main on SIGTERM or SIGINT, then exits
+    '''
+    def __init__(self, count: int, main: WorkerMain, pin_cpus: bool=False) -> None:
+        self.count = count
+        self.main = main
+        self.pin_cpus = pin_cpus
+        # pid -> worker index
+        self.pids: Dict[int, int] = {}
+        self.started_at: Dict[int, float] = {}
+        self.stopping = False
+        # set in a worker
+        self.worker_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.worker_stop: Optional[asyncio.Event] = None
+        self.worker_stopping = False
+
+    def spawn(self, index: int) -> None:
+        if self.stopping:
+            return
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = self.run_child(index)
+            except BaseException:
+                logger.error('worker %s failed', index, exc_info=True)
+            finally:
+                os._exit(code)
+        self.pids[pid] = index
+        self.started_at[index] = time.time()
+        logger.info('worker %s started as pid %s', index, pid)
+
+    def run_child(self, index: int) -> int:
+        '''
+        Serve in a new thread, the forking thread still holds the
+        running loop of the parent and only waits for signals
+        '''
+        signal.set_wakeup_fd(-1)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.on_worker_signal)
+
+        if self.pin_cpus and hasattr(os, 'sched_setaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+            cpu = cpus[index % len(cpus)]
+            os.sched_setaffinity(0, {cpu})
+            logger.info('worker %s pinned to cpu %s', index, cpu)
+
+        failed = []
+        def run() -> None:
+            try:
+                asyncio.run(self.serve(index))
+            except BaseException:
+                logger.error('worker %s failed', index, exc_info=True)
+                failed.append(index)
+
+        thread = threading.Thread(target=run,
+                                  name='bbox-worker-{}'.format(index))
+        thread.start()
+        while thread.is_alive():
+            thread.join(SUPERVISE_INTERVAL_SECS)
+        return 1 if failed else 0
+
+    def on_worker_signal(self, signum: int, frame: object) -> None:
+        self.worker_stopping = True
+        if self.worker_loop is not None and self.worker_stop is not None:
+            self.worker_loop.call_soon_threadsafe(self.worker_stop.set)
+
+    async def serve(self, index: int) -> None:
+        self.worker_stop = asyncio.Event()
+        self.worker_loop = asyncio.get_event_loop()
+        if self.worker_stopping:
+            self.worker_stop.set()
+        shutdown = await self.main(index)
+        await self.worker_stop.wait()
+        logger.info('worker %s stopping', index)
+        if shutdown is not None:
+            await shutdown()
+
+    def reap(self) -> None:
+        for pid in list(self.pids):
+            try:
+                done, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done, status = pid, 0
+            if not done:
+                continue
+            index = self.pids.pop(pid)
+            if self.stopping:
+                continue
+            logger.warn('worker %s pid %s exited with status %s, restarting',
+                        index, pid, status)
+            # do not restart a crashing worker in a busy loop
+            delay = RESTART_DELAY_SECS - (time.time() - self.started_at[index])
+            if delay > 0:
+                asyncio.get_event_loop().call_later(
+                    delay, self.spawn, index)
+            else:
+                self.spawn(index)
+
+    async def supervise(self) -> None:
+        for index in range(self.count):
+            self.spawn(index)
+        while not self.stopping:
+            await asyncio.sleep(SUPERVISE_INTERVAL_SECS)
+            self.reap()
+
+    async def stop(self, timeout: float=STOP_TIMEOUT_SECS) -> None:
+        self.stopping = True
+        self.signal_all(signal.SIGTERM)
+        deadline = time.time() + timeout
+        while self.pids and time.time() < deadline:
+            await asyncio.sleep(0.1)
+            self.reap()
+        if self.pids:
+            logger.warn('killing workers %s', list(self.pids.values()))
+            self.signal_all(signal.SIGKILL)
+            self.reap()
+
+    def signal_all(self, signum: int) -> None:
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
@@ -32,5 +32,9 @@ setup(name='aiobbox',
           'etcd3-py',
           'sentry-sdk >= 1.3.1',
       ],
+      extras_require={
+          # faster json and the compact msgpack wire codec
+          'fast': ['orjson', 'msgpack'],
+      },
       python_requires='>=3.8',
 )
@@ -0,0 +1,64 @@
+import asyncio
+import pytest
+from aiobbox.admission import Admission
+from aiobbox.exceptions import ServiceOverloaded
+
+def test_admission_queue():
+    async def run():
+        admission = Admission('/test/admission')
+        await admission.acquire(1, 1)
+        waiter = asyncio.ensure_future(admission.acquire(1, 1))
+        await asyncio.sleep(0)
+        assert (admission.inflight, admission.queued) == (1, 1)
+
+        with pytest.raises(ServiceOverloaded):
+            await admission.acquire(1, 1)
+
+        admission.release(1)
+        await waiter
+        assert (admission.inflight, admission.queued) == (1, 0)
+        admission.release(1)
+        assert admission.inflight == 0
+
+    asyncio.run(run())
+
+def test_admission_cancel():
+    async def run():
+        admission = Admission('/test/admission')
+        await admission.acquire(1, 5)
+        waiter = asyncio.ensure_future(admission.acquire(1, 5))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        assert admission.queued == 0
+        admission.release(1)
+        assert admission.inflight == 0
+
+    asyncio.run(run())
+
+def test_admission_priority():
+    async def run():
+        admission = Admission('/test/admission')
+        await admission.acquire(1, 2)
+        order = []
+
+        async def call(priority):
+            await admission.acquire(1, 2, priority=priority)
+            order.append(priority)
+            admission.release(1)
+
+        low = asyncio.ensure_future(call('low'))
+        normal = asyncio.ensure_future(call('normal'))
+        await asyncio.sleep(0)
+        # the queue is full, the least urgent waiter is shed
+        high = asyncio.ensure_future(call('high'))
+        await asyncio.sleep(0)
+        with pytest.raises(ServiceOverloaded):
+            await low
+
+        admission.release(1)
+        await asyncio.gather(normal, high)
+        assert order == ['high', 'normal']
+        assert admission.inflight == 0
+
+    asyncio.run(run())
@@ -0,0 +1,57 @@
+import pytest
+from aiobbox.balancer import (
+    BindStats, choose_p2c,
+    choose_least_outstanding, choose_ewma,
+    locality_tiers, HashRing)
+
+def test_least_outstanding():
+    busy = BindStats()
+    busy.start()
+    stats = {'a:1': busy, 'b:2': BindStats()}
+    for _ in range(10):
+        assert choose_least_outstanding(['a:1', 'b:2'], stats) == 'b:2'
+        assert choose_p2c(['a:1', 'b:2'], stats) == 'b:2'
+
+def test_ewma():
+    slow = BindStats()
+    slow.finish(slow.start() - 2.0)
+    fast = BindStats()
+    fast.finish(fast.start() - 0.01)
+    assert slow.inflight == 0
+    assert slow.ewma > fast.ewma
+    stats = {'a:1': slow, 'b:2': fast}
+    for _ in range(10):
+        assert choose_ewma(['a:1', 'b:2'], stats) == 'b:2'
+
+def test_locality_tiers():
+    boxes = {
+        '10.255.0.1:30001': {'zone': 'az1'},
+        '10.255.0.2:30001': {'zone': 'az2'},
+        '127.0.0.1:30001': {'zone': 'az2'},
+    }
+    binds = list(boxes.keys())
+    assert locality_tiers(binds, boxes, 'az1') == [
+        ['127.0.0.1:30001'],
+        ['10.255.0.1:30001'],
+        ['10.255.0.2:30001']]
+    assert locality_tiers(binds, boxes) == [
+        ['127.0.0.1:30001'],
+        ['10.255.0.1:30001', '10.255.0.2:30001']]
+
+def test_hash_ring():
+    binds = ['10.0.0.{}:30000'.format(i) for i in range(5)]
+    ring = HashRing(binds)
+    owners = {k: ring.get(k) for k in range(1000)}
+    assert set(owners.values()) == set(binds)
+    assert all(ring.get(k) == owners[k] for k in range(100))
+
+    # only keys of the leaving bind move
+    smaller = HashRing(binds[:4])
+    for k, bind in owners.items():
+        if bind != binds[4]:
+            assert smaller.get(k) == bind
+
+    # skipped binds hand their keys to the next one on the ring
+    allowed = set(binds[1:])
+    for k in range(100):
+        assert ring.get(k, allowed=allowed) in allowed
@@ -0,0 +1,88 @@
+import pytest
+import time
+from aiobbox.breaker import CircuitBreaker
+
+def test_open_and_probe():
+    breaker = CircuitBreaker('a:1', failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.available()
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    assert not breaker.available()
+
+    time.sleep(0.06)
+    assert breaker.available()
+    breaker.on_request()
+    assert breaker.state == breaker.HALF_OPEN
+    assert not breaker.available()
+
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    time.sleep(0.06)
+    breaker.on_request()
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED
+    assert breaker.available()
+
+def test_pool_breaker(monkeypatch):
+    import asyncio
+    from collections import defaultdict
+    from aiobbox import stats as bbox_stats
+    from aiobbox.client import SimpleHttpPool
+    from test.test_client import fake_boxes, FakeClient, hedged_pool
+
+    fake_boxes(monkeypatch, 'fake', ['127.0.0.1:1', '127.0.0.1:2'])
+    monkeypatch.setattr(bbox_stats.client_breaker_trip_count, 'values',
+                        defaultdict(float))
+    trips = bbox_stats.client_breaker_trip_count.values
+
+    async def run():
+        pool = SimpleHttpPool(policy=SimpleHttpPool.FIRST,
+                              breaker_failures=1, breaker_reset=0.05)
+        try:
+            # a timeout is a failure and ejects the bind
+            client = pool.get_client('fake')
+            assert client.connect == '127.0.0.1:1'
+            timed_out = FakeClient(client.connect,
+                                   error=asyncio.TimeoutError())
+            timed_out.conn = client.conn
+            with pytest.raises(asyncio.TimeoutError):
+                await pool._call_client(timed_out, timed_out.request_obj,
+                                        None)
+            breaker = pool.get_breaker('127.0.0.1:1')
+            assert breaker.state == breaker.OPEN
+            assert trips['127.0.0.1:1'] == 1
+            assert pool.get_client('fake').connect == '127.0.0.1:2'
+
+            # after reset_timeout one probe gets through, others
+            # keep away until it is answered
+            time.sleep(0.06)
+            probe = pool.get_client('fake')
+            assert probe.connect == '127.0.0.1:1'
+            start_time = pool._start_call(probe)
+            assert breaker.state == breaker.HALF_OPEN
+            assert pool.get_client('fake').connect == '127.0.0.1:2'
+            await pool._finish_call(probe, start_time, True, False)
+            assert breaker.state == breaker.CLOSED
+            assert pool.get_client('fake').connect == '127.0.0.1:1'
+
+            # every bind ejected, they are tried anyway
+            for bind in ('127.0.0.1:1', '127.0.0.1:2'):
+                pool.get_breaker(bind).record_failure()
+            assert pool.get_client('fake').connect == '127.0.0.1:1'
+        finally:
+            await pool.close()
+
+        # the cancelled copy of a hedged call proves nothing
+        slow, fast = FakeClient('a', delay=1), FakeClient('b')
+        pool = hedged_pool(monkeypatch, slow, fast)
+        resp = await pool.request('fake', 'm', hedge=0.01)
+        assert resp['result'] == 'b'
+        await asyncio.sleep(0)
+        assert slow.cancelled
+        breaker = pool.get_breaker('a')
+        assert breaker.state == breaker.CLOSED
+        assert breaker.failures == 0
+        assert pool.get_stats('a').inflight == 0
+
+    asyncio.run(run())
@@ -0,0 +1,108 @@
+import pytest
+import time
+from collections import defaultdict
+from aiobbox.cache import LRUCache
+
+def test_lru_evict():
+    cache = LRUCache(2)
+    cache.set('a', 1, 60)
+    cache.set('b', 2, 60)
+    assert cache.get('a') == 1
+    cache.set('c', 3, 60)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert len(cache) == 2
+
+def test_ttl_expire():
+    cache = LRUCache(2)
+    cache.set('a', 1, -1)
+    assert cache.get('a') is None
+    assert 'a' not in cache
+    cache.set(('srv', 'm', '[1]'), 1, 60)
+    assert cache.delete_if(lambda key: key[0] == 'srv') == 1
+
+def test_pool_cache(monkeypatch):
+    import asyncio
+    from aiobbox import server, client
+    from aiobbox import stats as bbox_stats
+    from aiobbox.client import SimpleHttpPool
+    from test.test_client import fake_boxes, start_site
+
+    srv = server.Service()
+    calls = []
+
+    @srv.method('square', cache_ttl=60)
+    async def square(request, v):
+        calls.append(v)
+        return v * v
+
+    @srv.method('plain')
+    async def plain(request, v):
+        calls.append(v)
+        return v
+
+    srv.register('test_cache')
+    # the pool reaches the service over the network, not in process
+    monkeypatch.setattr(client, 'has_service', lambda srv_name: False)
+    monkeypatch.setattr(bbox_stats.client_cache_hit_count, 'values',
+                        defaultdict(float))
+    monkeypatch.setattr(bbox_stats.client_cache_miss_count, 'values',
+                        defaultdict(float))
+    hits = bbox_stats.client_cache_hit_count.values
+    misses = bbox_stats.client_cache_miss_count.values
+    stats_name = '/test_cache/square'
+
+    async def run():
+        runner, url = await start_site(server.make_app())
+        fake_boxes(monkeypatch, 'test_cache', [url[len('http://'):]])
+        pool = SimpleHttpPool()
+        try:
+            # the first response carries the hint and fills the cache
+            resp = await pool.request('test_cache', 'square', 3)
+            assert resp['result'] == 9
+            assert resp['cache_ttl'] == 60
+            assert pool.cache_ttls[('test_cache', 'square')] == 60
+            assert calls == [3]
+
+            resp = await pool.request('test_cache', 'square', 3,
+                                      req_id='again')
+            assert resp['result'] == 9
+            assert resp['id'] == 'again'
+            assert calls == [3]
+            assert hits[stats_name] == 1
+
+            await pool.request('test_cache', 'square', 4)
+            assert calls == [3, 4]
+            assert misses[stats_name] == 1
+
+            # methods without a ttl are never cached
+            await pool.request('test_cache', 'plain', 5)
+            await pool.request('test_cache', 'plain', 5)
+            assert calls == [3, 4, 5, 5]
+            assert ('test_cache', 'plain') not in pool.cache_ttls
+
+            assert pool.invalidate('test_cache', 'square', 3) == 1
+            await pool.request('test_cache', 'square', 3)
+            assert calls == [3, 4, 5, 5, 3]
+            assert pool.invalidate('test_cache') == 2
+            await pool.request('test_cache', 'square', 4)
+            assert calls == [3, 4, 5, 5, 3, 4]
+            assert misses[stats_name] == 3
+
+            # hints are learned up front, the first call is a miss
+            fresh = SimpleHttpPool()
+            try:
+                assert await fresh.discover_cache_hints(
+                    'test_cache') == {'square': 60}
+                await fresh.request('test_cache', 'square', 6)
+                assert misses[stats_name] == 4
+                await fresh.request('test_cache', 'square', 6)
+                assert calls == [3, 4, 5, 5, 3, 4, 6]
+                assert hits[stats_name] == 2
+            finally:
+                await fresh.close()
+        finally:
+            await pool.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
@@ -0,0 +1,480 @@
+import pytest
+import asyncio
+from aiobbox.client import SimpleHttpPool, get_retry_after
+
+def test_retry_after():
+    assert get_retry_after({'result': 1}) is None
+    assert get_retry_after({'error': {'code': 'other'}}) is None
+    assert get_retry_after({'error': {'code': 'overloaded'}}) == 0
+    assert get_retry_after(
+        {'error': {'code': 'overloaded', 'retry_after': 1.5}}) == 1.5
+
+def test_retry_backoff():
+    pool = SimpleHttpPool()
+    for attempt in range(1, 10):
+        assert 0 <= pool.retry_backoff(attempt) <= 2.0
+    assert pool.retry_backoff(1, retry_after=3) == 3
+
+def fake_boxes(monkeypatch, srv_name, binds):
+    from aiobbox.cluster import get_cluster
+    cluster = get_cluster()
+    boxes = {bind: {'bind': bind, 'ssl': '', 'boxid': 'box{}'.format(i),
+                    'zone': '', 'services': [srv_name]}
+             for i, bind in enumerate(binds)}
+    monkeypatch.setattr(cluster, 'boxes', boxes)
+    monkeypatch.setattr(cluster, 'route', {srv_name: list(binds)})
+    return cluster
+
+def test_connection_removed_in_flight(monkeypatch):
+    import asyncio
+    cluster = fake_boxes(monkeypatch, 'fake', ['127.0.0.1:1'])
+
+    async def run():
+        pool = SimpleHttpPool()
+        client = pool.get_client('fake')
+        conn = client.conn
+        start_time = pool._start_call(client)
+        assert conn.pending == 1
+
+        # the box leaves the route while the call is in flight
+        cluster.boxes = {}
+        pool.sweep_connections(force=True)
+        assert '127.0.0.1:1' not in pool.connections
+        await asyncio.sleep(0.05)
+        assert not conn.session.closed
+
+        await pool._finish_call(client, start_time, ok=True, failed=False)
+        assert conn.pending == 0
+        await asyncio.sleep(0.2)
+        assert conn.session.closed
+
+    asyncio.run(run())
+
+def test_retry_connection_errors(monkeypatch):
+    import socket
+    import asyncio
+    from aiohttp import web
+    from aiobbox.exceptions import ConnectionError
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    good = '127.0.0.1:{}'.format(sock.getsockname()[1])
+    # nothing listens on a port that was bound and closed
+    closed = socket.socket()
+    closed.bind(('127.0.0.1', 0))
+    refused = '127.0.0.1:{}'.format(closed.getsockname()[1])
+    closed.close()
+
+    cluster = fake_boxes(monkeypatch, 'fake', [refused, good])
+    async def get_boxes():
+        pass
+    monkeypatch.setattr(cluster, 'get_boxes', get_boxes)
+
+    async def handle(request):
+        body = await request.json()
+        return web.json_response(
+            {'jsonrpc': '2.0', 'id': body['id'], 'result': 'ok'})
+
+    chosen = []
+    def refused_first(binds, stats):
+        bind = refused if not chosen else good
+        chosen.append(bind)
+        return bind
+
+    async def run():
+        app = web.Application()
+        app.router.add_post('/jsonrpc/2.0/api', handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.SockSite(runner, sock).start()
+        pool = SimpleHttpPool(policy=refused_first)
+        try:
+            resp = await pool.request('fake', 'echo', retry=2)
+            assert resp['result'] == 'ok'
+            assert chosen == [refused, good]
+
+            pool.policy = lambda binds, stats: refused
+            with pytest.raises(ConnectionError):
+                await pool.request('fake', 'echo', retry=1)
+        finally:
+            await pool.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+def test_batch_shrinks_timeout():
+    import time
+    import asyncio
+    from aiobbox.server import Service
+    from aiobbox import deadline as bbox_deadline
+
+    srv = Service()
+
+    @srv.method('left')
+    async def left(request):
+        return bbox_deadline.remaining()
+
+    srv.register('test_batch_deadline')
+
+    async def run():
+        pool = SimpleHttpPool()
+        token = bbox_deadline.set_deadline(time.time() + 2)
+        try:
+            batch = pool.batch()
+            batch.test_batch_deadline.left()
+            resps = await batch.run()
+            assert 0 < resps[0]['result'] <= 2
+        finally:
+            bbox_deadline.reset_deadline(token)
+
+        token = bbox_deadline.set_deadline(time.time() - 1)
+        try:
+            batch = pool.batch()
+            batch.test_batch_deadline.left()
+            with pytest.raises(asyncio.TimeoutError):
+                await batch.run()
+            with pytest.raises(asyncio.TimeoutError):
+                async for item in pool.stream('test_batch_deadline', 'left'):
+                    pass
+        finally:
+            bbox_deadline.reset_deadline(token)
+
+    asyncio.run(run())
+
+def test_batch_partial_failure():
+    from aiobbox.server import Service
+
+    srv = Service()
+
+    @srv.method('echo')
+    async def echo(request, v):
+        return v
+
+    srv.register('test_batch_local')
+
+    async def run():
+        pool = SimpleHttpPool()
+        batch = pool.batch()
+        batch.test_batch_local.echo(1)
+        batch.test_batch_missing.foo(2)
+        batch.test_batch_local.echo(3)
+        ids = [req.req_id for req in batch.reqs]
+        resps = await batch.run()
+        assert [r.get('result') for r in resps] == [1, None, 3]
+        # the failed entry keeps its id and says why
+        assert resps[1]['id'] == ids[1]
+        assert resps[1]['error']['code'] == 'no service found'
+
+    asyncio.run(run())
+
+class FakeClient:
+    '''
+    Answers after delay seconds, or raises error
+    '''
+    def __init__(self, connect, delay=0, error=None):
+        self.connect = connect
+        self.conn = None
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+        self.cancelled = False
+
+    async def request_obj(self, req, timeout=None):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error is not None:
+            raise self.error
+        return {'jsonrpc': '2.0', 'id': req.req_id, 'result': self.connect}
+
+    async def close(self):
+        pass
+
+def hedged_pool(monkeypatch, *clients):
+    pool = SimpleHttpPool()
+    def get_client(srv_name, policy=None, boxid=None, exclude=(), hash_key=None):
+        for client in clients:
+            if client.connect not in exclude:
+                return client
+        return None
+    monkeypatch.setattr(pool, 'get_client', get_client)
+    return pool
+
+def test_hedged_requests(monkeypatch):
+    from aiobbox.exceptions import ConnectionError
+
+    async def run():
+        # the hedge answers first and the slow copy is cancelled
+        slow, fast = FakeClient('a', delay=1), FakeClient('b')
+        pool = hedged_pool(monkeypatch, slow, fast)
+        resp = await pool.request('fake', 'm', hedge=0.01)
+        assert resp['result'] == 'b'
+        await asyncio.sleep(0)
+        assert slow.cancelled
+
+        # a fast failure is hedged at once
+        broken = FakeClient('a', error=ConnectionError('refused'))
+        pool = hedged_pool(monkeypatch, broken, FakeClient('b'))
+        resp = await pool.request('fake', 'm', hedge=10)
+        assert resp['result'] == 'b'
+
+        # no hedges beyond the budget
+        slow, other = FakeClient('a', delay=0.05), FakeClient('b')
+        pool = hedged_pool(monkeypatch, slow, other)
+        pool.hedge_budget.tokens = 0
+        resp = await pool.request('fake', 'm', hedge=0.01)
+        assert resp['result'] == 'a'
+        assert other.calls == 0
+
+        # retry is honoured, every attempt is a hedged pair
+        a = FakeClient('a', error=ConnectionError('refused'))
+        b = FakeClient('b', error=ConnectionError('refused'))
+        pool = hedged_pool(monkeypatch, a, b)
+        with pytest.raises(ConnectionError):
+            await pool.request('fake', 'm', hedge=0.01, retry=1)
+        assert (a.calls, b.calls) == (2, 2)
+
+    asyncio.run(run())
+
+def test_auto_batcher(monkeypatch):
+    import time
+    from aiobbox.jsonrpc import Request
+
+    pool = SimpleHttpPool(batch_window=0.05, batch_size=2)
+    sent = []
+    async def request_group(srv_name, batch, timeout=None, retry=0, policy=None):
+        sent.append((len(batch.reqs), timeout, time.time()))
+        return [{'jsonrpc': '2.0', 'id': req.req_id, 'result': req.params[0]}
+                for req in batch.reqs]
+    monkeypatch.setattr(pool, '_request_group', request_group)
+
+    async def call(n, timeout):
+        req = Request.make(n, 'fake', 'echo', n)
+        return await pool.auto_batcher.request_obj(req, timeout=timeout)
+
+    async def run():
+        # different timeouts share a batch sent with the longest one
+        resps = await asyncio.gather(call(1, 3), call(2, 5))
+        assert [r['result'] for r in resps] == [1, 2]
+        assert [r['id'] for r in resps] == [1, 2]
+        assert sent[0][:2] == (2, 5)
+
+        # the timer of a batch flushed by size does not cut the
+        # window of the next one short
+        await asyncio.sleep(0.03)
+        start = time.time()
+        resp = await call(3, 3)
+        assert resp['result'] == 3
+        assert sent[1][0] == 1
+        assert sent[1][2] - start >= 0.04
+
+    asyncio.run(run())
+
+async def start_site(app):
+    import socket
+    from aiohttp import web
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.SockSite(runner, sock).start()
+    return runner, 'http://127.0.0.1:{}'.format(sock.getsockname()[1])
+
+def test_websocket_transport():
+    import aiohttp
+    from aiobbox import server
+    from aiobbox.client import WebSocketTransport
+
+    srv = server.Service()
+
+    @srv.method('echo')
+    async def echo(request, v, secs=0):
+        await asyncio.sleep(secs)
+        return v
+
+    srv.register('test_ws')
+
+    def call(req_id, v, secs=0):
+        return {'jsonrpc': '2.0', 'id': req_id,
+                'method': 'test_ws::echo', 'params': [v, secs]}
+
+    async def run():
+        runner, url = await start_site(server.make_app())
+        session = aiohttp.ClientSession()
+        transport = WebSocketTransport(url, session)
+        try:
+            # the same id in flight twice is still told apart
+            resps = await asyncio.gather(
+                transport.send_payload(call(7, 'a', 0.05)),
+                transport.send_payload(call(7, 'b')))
+            assert resps == [{'jsonrpc': '2.0', 'id': 7, 'result': 'a'},
+                             {'jsonrpc': '2.0', 'id': 7, 'result': 'b'}]
+
+            resps = await transport.send_payload(
+                [call(1, 'x'), call(2, 'y'), call(1, 'z')])
+            assert [(r['id'], r['result']) for r in resps] == [
+                (1, 'x'), (2, 'y'), (1, 'z')]
+            assert not transport.waiters
+        finally:
+            await transport.close()
+            await session.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+def test_websocket_large_message():
+    import aiohttp
+    from aiobbox import server
+    from aiobbox.client import WebSocketTransport
+
+    srv = server.Service()
+
+    @srv.method('blob')
+    async def blob(request, size):
+        return 'x' * size
+
+    @srv.method('echo')
+    async def echo(request, v, secs=0):
+        await asyncio.sleep(secs)
+        return v
+
+    srv.register('test_ws_large')
+
+    def call(req_id, method, *params):
+        return {'jsonrpc': '2.0', 'id': req_id,
+                'method': 'test_ws_large::' + method,
+                'params': list(params)}
+
+    async def run():
+        runner, url = await start_site(server.make_app())
+        session = aiohttp.ClientSession()
+        transport = WebSocketTransport(url, session)
+        size = 5 * 1024 * 1024
+        try:
+            # a frame over aiohttp's 4MB default keeps the socket up
+            big, small = await asyncio.gather(
+                transport.send_payload(call(1, 'blob', size)),
+                transport.send_payload(call(2, 'echo', 'a', 0.3)))
+            assert len(big['result']) == size
+            assert small['result'] == 'a'
+
+            resp = await transport.send_payload(
+                call(3, 'echo', 'y' * size))
+            assert len(resp['result']) == size
+        finally:
+            await transport.close()
+            await session.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+def test_websocket_dropped():
+    import aiohttp
+    from aiohttp import web
+    from aiobbox.client import WebSocketTransport
+    from aiobbox.exceptions import ConnectionError
+
+    async def drop(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.receive()
+        await ws.close()
+        return ws
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/jsonrpc/2.0/ws', drop)
+        runner, url = await start_site(app)
+        session = aiohttp.ClientSession()
+        transport = WebSocketTransport(url, session)
+        try:
+            with pytest.raises(ConnectionError):
+                await transport.send_payload(
+                    {'jsonrpc': '2.0', 'id': 1,
+                     'method': 'x::y', 'params': []}, timeout=5)
+            assert not transport.waiters
+            assert not transport.connected
+        finally:
+            await transport.close()
+            await session.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+def test_unix_path_resolved_once(monkeypatch, tmp_path):
+    import os
+    sock_path = str(tmp_path / 'box.sock')
+    open(sock_path, 'w').close()
+    cluster = fake_boxes(monkeypatch, 'fake', ['127.0.0.1:1'])
+    cluster.boxes['127.0.0.1:1']['unix'] = sock_path
+
+    stats = []
+    exists = os.path.exists
+    def counting_exists(path):
+        stats.append(path)
+        return exists(path)
+    monkeypatch.setattr(os.path, 'exists', counting_exists)
+
+    async def run():
+        pool = SimpleHttpPool()
+        try:
+            for _ in range(3):
+                client = pool.get_client('fake')
+                assert client.conn.unix_path == sock_path
+            assert stats.count(sock_path) == 1
+
+            # a new advertised path replaces the connection
+            cluster.boxes['127.0.0.1:1']['unix'] = ''
+            assert pool.get_client('fake').conn.unix_path == ''
+        finally:
+            await pool.close()
+
+    asyncio.run(run())
+
+def test_unix_path_failed(monkeypatch, tmp_path):
+    from aiohttp import web
+    from aiobbox.exceptions import ConnectionError
+
+    # a file left behind by a dead box, nothing can connect to it
+    sock_path = str(tmp_path / 'stale.sock')
+    open(sock_path, 'w').close()
+
+    async def handle(request):
+        body = await request.json()
+        return web.json_response(
+            {'jsonrpc': '2.0', 'id': body['id'], 'result': 'tcp'})
+
+    async def run():
+        app = web.Application()
+        app.router.add_post('/jsonrpc/2.0/api', handle)
+        runner, url = await start_site(app)
+        bind = url[len('http://'):]
+        cluster = fake_boxes(monkeypatch, 'fake', [bind])
+        cluster.boxes[bind]['unix'] = sock_path
+        async def get_boxes():
+            pass
+        monkeypatch.setattr(cluster, 'get_boxes', get_boxes)
+
+        pool = SimpleHttpPool()
+        try:
+            assert pool.get_client('fake').conn.unix_path == sock_path
+            with pytest.raises(ConnectionError):
+                await pool.request('fake', 'echo')
+
+            # the replacement connection goes over TCP
+            assert pool.get_client('fake').conn.unix_path == ''
+            resp = await pool.request('fake', 'echo')
+            assert resp['result'] == 'tcp'
+
+            # a newly advertised socket is tried again
+            cluster.boxes[bind]['unix'] = sock_path + '.new'
+            open(sock_path + '.new', 'w').close()
+            assert pool.get_client('fake').conn.unix_path == sock_path + '.new'
+        finally:
+            await pool.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
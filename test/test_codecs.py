@@ -0,0 +1,30 @@
+import pytest
+import pytz
+from decimal import Decimal
+from datetime import datetime, date
+
+from aiobbox import codecs
+
+def test_json_codec_types():
+    v = {'at': datetime(2021, 5, 24, 3, 1, 16, 500, tzinfo=pytz.UTC),
+         'day': date(2021, 5, 24),
+         'amount': Decimal('1.234'),
+         'big': 2 ** 70}
+    data = codecs.json_codec.decode(codecs.json_codec.encode(v))
+    assert data == {'at': '2021-05-24T03:01:16+00:00',
+                    'day': '2021-05-24',
+                    'amount': '1.234',
+                    'big': 2 ** 70}
+
+def test_json_codec_stdlib(monkeypatch):
+    monkeypatch.setattr(codecs, 'orjson', None)
+    assert codecs.loads(codecs.dumps({'a': Decimal('1.5')})) == {'a': '1.5'}
+
+def test_negotiate():
+    assert codecs.get_codec(None) is codecs.json_codec
+    assert codecs.get_codec('application/json; charset=utf-8') is codecs.json_codec
+    assert codecs.negotiate('*/*') is codecs.json_codec
+    if codecs.has_codec('msgpack'):
+        codec = codecs.negotiate('application/msgpack, application/json')
+        assert codec.name == 'msgpack'
+        assert codec.decode(codec.encode([1, 'a', Decimal('2')])) == [1, 'a', '2']
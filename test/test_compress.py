@@ -0,0 +1,23 @@
+import gzip
+import zlib
+
+from aiobbox import compress
+
+def test_choose_encoding():
+    assert compress.choose_encoding(None) is None
+    assert compress.choose_encoding('br') is None
+    assert compress.choose_encoding('deflate, gzip') == 'gzip'
+    assert compress.choose_encoding('gzip;q=0, deflate') == 'deflate'
+
+def test_compress_body(monkeypatch):
+    monkeypatch.setattr(compress, 'COMPRESS_MIN_SIZE', 100)
+    body, encoding = compress.compress_body(b'a' * 10, 'gzip', 'test')
+    assert (body, encoding) == (b'a' * 10, None)
+
+    body, encoding = compress.compress_body(b'a' * 1000, 'gzip', 'test')
+    assert encoding == 'gzip'
+    assert gzip.decompress(body) == b'a' * 1000
+
+    body, encoding = compress.compress_body(b'a' * 1000, 'deflate', 'test')
+    assert encoding == 'deflate'
+    assert zlib.decompress(body) == b'a' * 1000
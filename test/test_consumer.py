@@ -0,0 +1,46 @@
+import time
+import pytest
+from aiobbox.cluster import get_sharedconfig
+from aiobbox.exceptions import ServiceError
+from aiobbox.contrib.consumer.helpers import verify_token, token_digest
+from aiobbox.contrib.consumer.ratelimit import token_consumer
+
+def make_token(consumer, seed, expire_at):
+    digest = token_digest(consumer, str(expire_at), 'nonce', seed)
+    return ':'.join([consumer, str(expire_at), 'nonce', digest])
+
+def test_verify_token():
+    cfg = get_sharedconfig()
+    cfg.set('consumers', 'test_rl', {'secret': 's', 'seed': 'seed1'})
+    token = make_token('test_rl', 'seed1', int(time.time()) + 3600)
+    assert verify_token(token)['consumer'] == 'test_rl'
+    assert token_consumer(token) == 'test_rl'
+
+    # a new seed invalidates the remembered token
+    cfg.set('consumers', 'test_rl', {'secret': 's', 'seed': 'seed2'})
+    with pytest.raises(ServiceError):
+        verify_token(token)
+    assert token_consumer(token) is None
+
+    expired = make_token('test_rl', 'seed2', int(time.time()) - 1)
+    with pytest.raises(ServiceError):
+        verify_token(expired)
+    assert token_consumer('test_rl:1:2:3') is None
+
+def test_verify_tokens_bulk():
+    import asyncio
+    from aiobbox.contrib.consumer.service import verify_consumer_tokens
+    cfg = get_sharedconfig()
+    cfg.set('consumers', 'test_bulk', {'secret': 's', 'seed': 'seed1'})
+    cfg.set('consumers', 'allow_create', True)
+    token = make_token('test_bulk', 'seed1', int(time.time()) + 3600)
+    try:
+        results = asyncio.run(verify_consumer_tokens(
+            None, [token, 'allow_create:9999999999:a:b', 3]))
+    finally:
+        cfg.delete('consumers', 'allow_create')
+    assert results[0]['verified'] and results[0]['consumer'] == 'test_bulk'
+    assert results[1] == {'verified': False,
+                          'code': 'consumer not found',
+                          'message': 'consumer not found'}
+    assert results[2]['code'] == 'invalid token'
@@ -0,0 +1,18 @@
+import pytest
+from aiobbox.jsonrpc import Request, BatchRequest, DataError
+
+def test_batch_match_responses():
+    batch = BatchRequest([
+        Request.make(1, 'calc', 'add2num', 1, 2),
+        Request.make(2, 'calc', 'add2num', 3, 4),
+        Request.make(3, 'calc', 'add2num', 5, 6)])
+    assert [r['id'] for r in batch.as_json()] == [1, 2, 3]
+    resps = batch.match_responses([
+        {'id': 2, 'result': 7},
+        {'id': 1, 'result': 3}])
+    assert resps[0]['result'] == 3
+    assert resps[1]['result'] == 7
+    assert resps[2]['error']['code'] == 'no response'
+
+    with pytest.raises(DataError):
+        batch.match_responses({'id': 1, 'result': 3})
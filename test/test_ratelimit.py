@@ -0,0 +1,43 @@
+import pytest
+from aiobbox.contrib.consumer.ratelimit import gcra
+
+def test_gcra_burst():
+    tat = None
+    for _ in range(3):
+        tat, wait = gcra(tat, 100.0, rate=10, burst=3)
+        assert wait == 0
+    tat, wait = gcra(tat, 100.0, rate=10, burst=3)
+    assert wait == pytest.approx(0.1)
+    # one interval later a call is allowed again
+    tat, wait = gcra(tat, 100.1, rate=10, burst=3)
+    assert wait == 0
+
+def test_token_consumer():
+    import time
+    from aiobbox.cluster import get_sharedconfig
+    from aiobbox.contrib.consumer.helpers import token_digest
+    from aiobbox.contrib.consumer.ratelimit import token_consumer, get_rate_limit
+
+    cfg = get_sharedconfig()
+    cfg.set('consumers', 'test_tc', {'secret': 's', 'seed': 'seed1'})
+    cfg.set('consumers', 'allow_create', True)
+    cfg.set('consumers', 'no_seed', {'secret': 's'})
+    cfg.set('rate_limits', 'default', {'rate': 5})
+    expire_at = str(int(time.time()) + 3600)
+    digest = token_digest('test_tc', expire_at, 'nonce', 'seed1')
+    assert token_consumer(
+        ':'.join(['test_tc', expire_at, 'nonce', digest])) == 'test_tc'
+
+    # forged tokens do not charge the consumer they claim
+    assert token_consumer(
+        ':'.join(['test_tc', expire_at, 'nonce', 'forged'])) is None
+    # nor do other keys of the consumers section
+    assert token_consumer('allow_create:9999999999:a:b') is None
+    assert token_consumer('no_seed:9999999999:a:b') is None
+    assert token_consumer(None) is None
+
+    assert get_rate_limit('test_tc') == (5.0, 5)
+    cfg.delete('rate_limits', 'default')
+    assert get_rate_limit('test_tc') is None
+    cfg.delete('consumers', 'allow_create')
+    cfg.delete('consumers', 'no_seed')
@@ -12,3 +12,243 @@ def test_ticket():
     assert ticket.loaded
     assert ticket.name == 'bboxtest'
     assert ticket.bind_ip == '127.0.0.1'
+
+def test_streaming_method():
+    import asyncio
+    from aiobbox.server import Service, ServiceRequest, StreamResult
+    from aiobbox.jsonrpc import Request
+
+    srv = Service()
+
+    @srv.method('count')
+    async def count(request, n):
+        for i in range(n):
+            yield i
+
+    srv.register('test_stream')
+
+    async def run():
+        req = Request.make(1, 'test_stream', 'count', 3)
+        resp = await ServiceRequest(req).handle()
+        assert resp['result'] == [0, 1, 2]
+
+        resp = await ServiceRequest(req, stream=True).handle()
+        assert isinstance(resp['result'], StreamResult)
+        assert [i async for i in resp['result']] == [0, 1, 2]
+
+    asyncio.run(run())
+
+def test_encode_slices(monkeypatch):
+    import json
+    from aiobbox import server
+    monkeypatch.setattr(server, 'STREAM_ENCODE_SLICE_ITEMS', 3)
+    for result in ([], list(range(7)), {'a': 1},
+                   {str(i): [i] for i in range(10)}):
+        data = b''.join(server.encode_slices(result))
+        assert json.loads(data) == result
+
+def square(request, n):
+    return n * n
+
+def test_executor_methods():
+    import time
+    import asyncio
+    import threading
+    from aiobbox.server import Service, ServiceRequest
+    from aiobbox.executors import shutdown_executors
+    from aiobbox.jsonrpc import Request
+    from aiobbox import deadline as bbox_deadline
+
+    srv = Service()
+
+    @srv.method('where', executor='thread')
+    def where(request):
+        return (threading.current_thread() is threading.main_thread(),
+                bbox_deadline.remaining() is not None)
+
+    srv.method('square', executor='process')(square)
+    srv.register('test_executor')
+
+    with pytest.raises(TypeError):
+        @srv.method('bad', executor='thread')
+        async def bad(request):
+            pass
+
+    async def run():
+        req = Request.make(1, 'test_executor', 'where')
+        resp = await ServiceRequest(req, deadline=time.time() + 10).handle()
+        assert resp['result'] == (False, True)
+
+        req = Request.make(2, 'test_executor', 'square', 7)
+        resp = await ServiceRequest(req).handle()
+        assert resp['result'] == 49
+
+    try:
+        asyncio.run(run())
+    finally:
+        shutdown_executors()
+
+def test_batch_method():
+    import asyncio
+    from aiobbox.server import Service, ServiceRequest, handle_batch
+    from aiobbox.jsonrpc import Request
+
+    srv = Service()
+    batches = []
+
+    @srv.method('double')
+    async def double(request, n):
+        return n * 2
+
+    @srv.batch('double')
+    def double_batch(params_list):
+        batches.append(len(params_list))
+        return [ValueError('negative') if n < 0 else n * 2
+                for n, in params_list]
+
+    srv.register('test_batch')
+
+    async def run():
+        resps = await handle_batch([
+            {'jsonrpc': '2.0', 'id': i,
+             'method': 'test_batch::double', 'params': [i - 1]}
+            for i in range(5)])
+        assert batches == [5]
+        assert 'error' in resps[0]
+        assert [r['result'] for r in resps[1:]] == [0, 2, 4, 6]
+
+        reqs = [ServiceRequest(Request.make(i, 'test_batch', 'double', i))
+                for i in range(3)]
+        resps = await asyncio.gather(*[r.handle() for r in reqs])
+        assert batches == [5, 3]
+        assert [r['result'] for r in resps] == [0, 2, 4]
+
+    asyncio.run(run())
+
+def test_coalesced_method():
+    import asyncio
+    from aiobbox.server import Service, ServiceRequest
+    from aiobbox.jsonrpc import Request
+
+    srv = Service()
+    calls = []
+
+    @srv.method('load', coalesce=True)
+    async def load(request, key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        if key == 'bad':
+            raise ValueError(key)
+        return {'key': key}
+
+    srv.register('test_coalesce')
+
+    async def run():
+        reqs = [ServiceRequest(Request.make(i, 'test_coalesce', 'load', key))
+                for i, key in enumerate(['a', 'a', 'b', 'a', 'bad', 'bad'])]
+        resps = await asyncio.gather(*[r.handle() for r in reqs])
+        assert sorted(calls) == ['a', 'b', 'bad']
+        assert [r['id'] for r in resps] == list(range(6))
+        assert resps[1]['result'] == {'key': 'a'}
+        assert 'error' in resps[4] and 'error' in resps[5]
+
+        await ServiceRequest(Request.make(7, 'test_coalesce', 'load', 'a')).handle()
+        assert calls.count('a') == 2
+
+    asyncio.run(run())
+
+def test_coalesced_mixed_deadlines():
+    import time
+    import asyncio
+    from aiobbox.server import Service, ServiceRequest
+    from aiobbox.jsonrpc import Request
+
+    srv = Service()
+    calls = []
+
+    @srv.method('slow', coalesce=True)
+    async def slow(request):
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return 'done'
+
+    srv.register('test_coalesce_deadline')
+
+    async def run():
+        req = Request.make(1, 'test_coalesce_deadline', 'slow')
+        short = ServiceRequest(req, deadline=time.time() + 0.05)
+        req = Request.make(2, 'test_coalesce_deadline', 'slow')
+        long = ServiceRequest(req, deadline=time.time() + 30)
+        resps = await asyncio.gather(short.handle(), long.handle())
+        assert resps[0]['error']['code'] == 'deadline exceeded'
+        assert resps[1] == {'jsonrpc': '2.0', 'id': 2, 'result': 'done'}
+        assert len(calls) == 2
+
+    asyncio.run(run())
+
+def test_streaming_admission():
+    import asyncio
+    from aiobbox.server import Service, ServiceRequest, get_admission
+    from aiobbox.jsonrpc import Request
+    from aiobbox import priority as bbox_priority
+
+    srv = Service()
+
+    @srv.method('count', max_concurrency=1, max_queue=1)
+    async def count(request, n):
+        for i in range(n):
+            yield (i, bbox_priority.get_priority())
+
+    srv.register('test_stream_admission')
+    admission = get_admission('/test_stream_admission/count')
+
+    async def run():
+        req = Request.make(1, 'test_stream_admission', 'count', 3)
+        req.priority = 'high'
+        result = (await ServiceRequest(req, stream=True).handle())['result']
+        # the slot is held while the stream runs
+        assert admission.inflight == 1
+        items = [item async for item in result]
+        assert items == [(0, 'high'), (1, 'high'), (2, 'high')]
+        assert admission.inflight == 0
+
+        req = Request.make(2, 'test_stream_admission', 'count', 3)
+        result = (await ServiceRequest(req, stream=True).handle())['result']
+        await result.__anext__()
+        assert admission.inflight == 1
+        await result.aclose()
+        assert admission.inflight == 0
+
+    asyncio.run(run())
+
+def test_deadline_enforced():
+    import time
+    import asyncio
+    from aiobbox.server import Service, ServiceRequest
+    from aiobbox.jsonrpc import Request
+    from aiobbox import deadline as bbox_deadline
+
+    srv = Service()
+
+    @srv.method('sleep')
+    async def sleep(request, secs):
+        await asyncio.sleep(secs)
+        return bbox_deadline.remaining()
+
+    srv.register('test_deadline')
+
+    async def run():
+        req = Request.make(1, 'test_deadline', 'sleep', 0)
+        resp = await ServiceRequest(req, deadline=time.time() - 1).handle()
+        assert resp['error']['code'] == 'deadline exceeded'
+
+        req = Request.make(2, 'test_deadline', 'sleep', 1)
+        resp = await ServiceRequest(req, deadline=time.time() + 0.05).handle()
+        assert resp['error']['code'] == 'deadline exceeded'
+
+        # the method sees the deadline of its caller
+        req = Request.make(3, 'test_deadline', 'sleep', 0)
+        resp = await ServiceRequest(req, deadline=time.time() + 5).handle()
+        assert 0 < resp['result'] <= 5
+
+    asyncio.run(run())
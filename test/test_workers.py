@@ -0,0 +1,50 @@
+import os
+import signal
+import asyncio
+import pytest
+from aiobbox import workers
+from aiobbox.workers import WorkerSupervisor
+
+async def wait_until(cond, timeout=5.0):
+    for _ in range(int(timeout / 0.02)):
+        if cond():
+            return
+        await asyncio.sleep(0.02)
+    raise AssertionError('timed out')
+
+def test_supervisor(monkeypatch, tmp_path):
+    monkeypatch.setattr(workers, 'RESTART_DELAY_SECS', 0.1)
+    monkeypatch.setattr(workers, 'SUPERVISE_INTERVAL_SECS', 0.05)
+
+    def started():
+        return sorted(p.name for p in tmp_path.glob('started-*'))
+
+    async def main(index):
+        (tmp_path / 'started-{}'.format(os.getpid())).touch()
+        async def shutdown():
+            # in-flight work finishes before the worker exits
+            await asyncio.sleep(0.1)
+            (tmp_path / 'drained-{}'.format(os.getpid())).touch()
+        return shutdown
+
+    async def run():
+        supervisor = WorkerSupervisor(2, main)
+        task = asyncio.ensure_future(supervisor.supervise())
+        await wait_until(lambda: len(started()) == 2)
+        assert sorted(supervisor.pids.values()) == [0, 1]
+
+        # a dead worker is replaced under the same index
+        pid = next(iter(supervisor.pids))
+        os.kill(pid, signal.SIGKILL)
+        await wait_until(lambda: len(started()) == 3)
+        assert pid not in supervisor.pids
+        assert sorted(supervisor.pids.values()) == [0, 1]
+
+        live = list(supervisor.pids)
+        await supervisor.stop(timeout=5)
+        await task
+        assert not supervisor.pids
+        for pid in live:
+            assert (tmp_path / 'drained-{}'.format(pid)).exists()
+
+    asyncio.run(run())